@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Approximate nearest-neighbour retrieval over the catalog embeddings.
+
+IVFIndex partitions the L2-normalized catalog into k-means cells (an inverted
+file). A query visits only the n_probe cells whose centroids are closest to
+each liked cluster center, and recommendation then runs the exact
+liked-minus-disliked scoring on just those candidate rows.
+
+Build (or rebuild) the index for an embedding store:
+
+    python3 ann_index.py /var/data/catalog [--lists 1024]
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from embedding_store import normalize_rows
+
+INDEX_FILE = "ivf.npz"
+
+class IVFIndex:
+    """
+    Inverted-file index over catalog rows [0, size). Rows past size (products added
+    after the index was built) are always returned as candidates until a rebuild.
+    """
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @property
+    def size(self):
+        return len(self.order)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, sample_size=100000, chunk_size=65536, seed=42):
+        """
+        Train cell centroids with MiniBatchKMeans on a sample of the catalog,
+        then assign every row to its nearest centroid.
+        """
+        from sklearn.cluster import MiniBatchKMeans
+        num_rows = len(matrix)
+        if num_rows == 0:
+            raise ValueError("cannot build an index over an empty catalog")
+        if n_lists is None:
+            n_lists = int(np.clip(4 * np.sqrt(num_rows), 1, 4096))
+        n_lists = min(n_lists, num_rows)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(num_rows, min(num_rows, max(sample_size, n_lists)), replace=False))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=1, max_iter=20, batch_size=4096)
+        kmeans.fit(normalize_rows(matrix[sample])[0])
+        centroids = normalize_rows(kmeans.cluster_centers_)[0]
+
+        assignments = np.empty(num_rows, dtype=np.int64)
+        for start in range(0, num_rows, chunk_size):
+            chunk = normalize_rows(matrix[start:start + chunk_size])[0]
+            assignments[start:start + len(chunk)] = (chunk @ centroids.T).argmax(axis=1)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, order, offsets)
+
+    def candidates(self, queries, n_probe=8, total_rows=None):
+        """
+        Sorted, de-duplicated catalog rows in the n_probe cells nearest to any query,
+        plus every row in [size, total_rows) that the index does not cover yet.
+        """
+        queries = normalize_rows(np.atleast_2d(queries))[0]
+        n_probe = max(1, min(n_probe, self.n_lists))
+        similarities = queries @ self.centroids.T
+        if n_probe < self.n_lists:
+            probed = np.argpartition(-similarities, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probed = np.broadcast_to(np.arange(self.n_lists), similarities.shape)
+        cells = np.unique(probed)
+        rows = [self.order[self.offsets[cell]:self.offsets[cell + 1]] for cell in cells]
+        if total_rows is not None and total_rows > self.size:
+            rows.append(np.arange(self.size, total_rows, dtype=np.int64))
+        return np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["order"], data["offsets"])
+
+def load_or_build(store, n_lists=None, rebuild=False):
+    """
+    Load the index saved next to an EmbeddingStore, building and saving it if needed.
+    """
+    path = os.path.join(store.directory, INDEX_FILE)
+    if not rebuild and os.path.exists(path):
+        index = IVFIndex.load(path)
+        if index.size <= len(store):
+            return index
+        sys.stderr.write(f"ANN index {path} covers more rows than the store; rebuilding\n")
+    index = IVFIndex.build(store.matrix, n_lists=n_lists)
+    index.save(path)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the IVF index for a catalog embedding store")
+    parser.add_argument("store")
+    parser.add_argument("--lists", type=int, default=None, help="number of k-means cells (default 4*sqrt(n))")
+    args = parser.parse_args()
+    from embedding_store import EmbeddingStore
+    store = EmbeddingStore(args.store)
+    index = load_or_build(store, n_lists=args.lists, rebuild=True)
+    print(json.dumps({"rows": index.size, "lists": index.n_lists}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,793 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the recommendation pipeline.
+
+Runs on synthetic data so it does not need MongoDB or network access.
+
+    python3 benchmark.py scoring --sizes 1000 10000 100000
+    python3 benchmark.py encoding --batch-sizes 1 8 64 256 [--model all-MiniLM-L6-v2]
+    python3 benchmark.py ann --sizes 100000 --probes 4 8 16
+    python3 benchmark.py quantization --sizes 100000 --reranks 0 100
+    python3 benchmark.py sharding --sizes 200000 --workers 1 2 4 8
+    python3 benchmark.py products --sizes 10000 100000
+    python3 benchmark.py pipeline --sizes 1000 10000 100000 --output results.json
+    python3 benchmark.py compare base.json results.json
+    python3 benchmark.py coldstart [--with-model] [--snapshot-dir /app/model-cache]
+
+Every command prints one JSON object per measurement. With --output the rows
+are also saved with the git commit and library versions, so runs from
+different commits can be compared with the compare command.
+"""
+import os
+import sys
+import json
+import zlib
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+import recommendation
+import calculatePreferences
+from embedding_cache import EmbeddingCache, encode_in_batches
+from ann_index import IVFIndex
+from embedding_store import EmbeddingStore
+from quantization import PRECISIONS, QuantizedMatrix
+from product_batch import ProductBatch
+from wire_format import decode_vectors, is_blob
+import quantization
+
+EMBEDDING_DIM = 384
+
+def synthetic_catalog(num_products, dim=EMBEDDING_DIM, bad_fraction=0.001, seed=0):
+    """
+    Build a ProductBatch like get_product_batch's output, with a small fraction of
+    malformed (invalid) embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((num_products, dim)).astype(np.float32)
+    valid = np.ones(num_products, dtype=bool)
+    valid[rng.choice(num_products, int(num_products * bad_fraction), replace=False)] = False
+    matrix[~valid] = 0.0
+    return ProductBatch(
+        [f"post-{i}" for i in range(num_products)],
+        [f"product {i}" for i in range(num_products)],
+        matrix,
+        valid,
+    )
+
+def catalog_dataframe(products):
+    """
+    The products DataFrame the legacy implementations take, with one embedding
+    object per row (empty where the batch's row is invalid).
+    """
+    return pd.DataFrame({
+        "id": list(products.ids),
+        "description": [products.descriptions[i] for i in range(len(products))],
+        "embedding": [row if ok else np.zeros(0) for row, ok in zip(products.embeddings, products.valid)],
+    })
+
+def clustered_matrix(num_products, dim=EMBEDDING_DIM, topics=256, spread=0.6, seed=0):
+    """
+    Catalog embeddings drawn around a set of topic centers. Real product embeddings
+    are clustered like this, and uniform noise would make any ANN index look bad.
+    """
+    rng = np.random.default_rng(seed)
+    topic_centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    labels = rng.integers(0, topics, num_products)
+    noise = rng.standard_normal((num_products, dim)).astype(np.float32) * spread
+    return topic_centers[labels] + noise, topic_centers
+
+def synthetic_users(topic_centers, num_users, liked=3, disliked=3, spread=0.6, seed=3):
+    """
+    (liked, disliked) centers per user, normalized by recommendation.as_centers as
+    requests' centers are.
+    """
+    rng = np.random.default_rng(seed)
+    dim = topic_centers.shape[1]
+    users = []
+    for _ in range(num_users):
+        picks = rng.choice(len(topic_centers), liked + disliked, replace=False)
+        centers = topic_centers[picks] + rng.standard_normal((liked + disliked, dim)).astype(np.float32) * spread
+        users.append((recommendation.as_centers(centers[:liked]), recommendation.as_centers(centers[liked:])))
+    return users
+
+def synthetic_centers(num_centers, dim=EMBEDDING_DIM, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((num_centers, dim))
+
+class StubEncoder:
+    """
+    Offline stand-in for SentenceTransformer. Returns deterministic vectors and sleeps
+    for a fixed per-call overhead plus a cost proportional to the padded batch
+    (longest text in words x batch length), which is roughly how the real model behaves.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, call_overhead=0.003, token_cost=0.00002):
+        self.dim = dim
+        self.call_overhead = call_overhead
+        self.token_cost = token_cost
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if texts:
+            padded_tokens = max(len(text.split()) for text in texts) * len(texts)
+            time.sleep(self.call_overhead + padded_tokens * self.token_cost)
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i] = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(self.dim)
+        return vectors[0] if single else vectors
+
+def synthetic_descriptions(count, min_words=5, max_words=80, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    return [
+        " ".join(rng.choice(vocabulary, rng.integers(min_words, max_words + 1)))
+        for _ in range(count)
+    ]
+
+def legacy_recommend_products(user_liked_centers, user_disliked_centers, products_df, top_n=30, dislike_weight=1.0):
+    """
+    The per-row iterrows implementation recommend_products used to have, kept as a baseline.
+    """
+    from sklearn.metrics.pairwise import cosine_similarity
+    product_scores = []
+    for idx, row in products_df.iterrows():
+        try:
+            product_embedding = row["embedding"].reshape(1, -1)
+            liked_score = cosine_similarity(product_embedding, user_liked_centers).max()
+            disliked_score = 0
+            if user_disliked_centers is not None and len(user_disliked_centers) > 0:
+                disliked_score = cosine_similarity(product_embedding, user_disliked_centers).max()
+            product_scores.append(liked_score - dislike_weight * disliked_score)
+        except Exception:
+            product_scores.append(-9999)
+    products_df["final_score"] = product_scores
+    return products_df.sort_values("final_score", ascending=False).head(top_n)
+
+def legacy_products_dataframe(posts, model, cache=None):
+    """
+    get_products_dataframe as it was before ProductBatch: a list of dicts, then a
+    DataFrame with one numpy embedding per row. Kept as a baseline.
+    """
+    data = []
+    pending = []
+    for post in posts:
+        post_id = post.get('_id') or post.get('id')
+        description = post.get('description', '')
+        embedding = post.get('embedding', None)
+        if is_blob(embedding):
+            embedding = decode_vectors(embedding)
+        elif isinstance(embedding, str):
+            embedding = json.loads(embedding)
+        if embedding is None:
+            pending.append(len(data))
+        else:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        data.append({"id": post_id, "description": description, "embedding": embedding})
+    if pending:
+        encoded = (cache or EmbeddingCache(max_entries=0)).encode(
+            model, [data[i]["description"] for i in pending], fallback=np.zeros(EMBEDDING_DIM, dtype=np.float32))
+        for i, vector in zip(pending, encoded):
+            data[i]["embedding"] = vector
+    return pd.DataFrame(data)
+
+def stack_embeddings(embeddings, dim):
+    """
+    recommendation.stack_embeddings as it was before ProductBatch, for
+    legacy_dataframe_recommend: stack per-product embeddings into one float32 matrix.
+    Rows that cannot be used for scoring (wrong size, non-numeric or non-finite values)
+    are left as zeros and flagged False in the returned validity mask.
+    """
+    embeddings = list(embeddings)
+    try:
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if matrix.shape[1] == dim:
+            valid = np.isfinite(matrix).all(axis=1)
+            matrix[~valid] = 0.0
+            return matrix, valid
+    except Exception:
+        pass
+    # Ragged or malformed input: fall back to converting row by row.
+    matrix = np.zeros((len(embeddings), dim), dtype=np.float32)
+    valid = np.zeros(len(embeddings), dtype=bool)
+    for idx, embedding in enumerate(embeddings):
+        try:
+            vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            if vector.shape[0] != dim:
+                raise ValueError(f"expected {dim} values, got {vector.shape[0]}")
+            if not np.isfinite(vector).all():
+                raise ValueError("embedding contains non-finite values")
+            matrix[idx] = vector
+            valid[idx] = True
+        except Exception as e:
+            sys.stderr.write(f"Error reading embedding for product at index {idx}: {e}\n")
+    return matrix, valid
+
+def legacy_dataframe_recommend(user_liked_centers, user_disliked_centers, products_df, top_n=30, dislike_weight=1.0):
+    """
+    recommend_products as it was before ProductBatch: vectorized scoring of the
+    stacked DataFrame column, a final_score column and the top rows as records.
+    """
+    scores = np.full(len(products_df), recommendation.INVALID_SCORE, dtype=np.float64)
+    liked = recommendation.as_centers(user_liked_centers)
+    disliked = recommendation.as_centers(user_disliked_centers, dim=liked.shape[1])
+    stacked, valid = stack_embeddings(products_df["embedding"], liked.shape[1])
+    scores[valid] = recommendation.score_embeddings(stacked[valid], liked, disliked, dislike_weight)
+    products_df["final_score"] = scores
+    top = recommendation.select_top_n(scores, top_n)
+    return products_df.iloc[top][['id', 'description', 'final_score']].to_dict(orient='records')
+
+def time_call(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def summarize(timings):
+    timings = np.asarray(timings) * 1000.0
+    return {
+        "mean_ms": round(float(timings.mean()), 3),
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p90_ms": round(float(np.percentile(timings, 90)), 3),
+        "p99_ms": round(float(np.percentile(timings, 99)), 3),
+        "min_ms": round(float(timings.min()), 3),
+    }
+
+def peak_traced_mb(func):
+    """
+    Peak memory allocated by one call of func, as seen by tracemalloc (numpy
+    buffers included). Run separately from the timed calls, which it would slow down.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 2**20, 2)
+
+def traced_allocations(func):
+    """
+    Peak memory of one call of func and the memory blocks it leaves allocated (the
+    size and allocation count of what it returns), as seen by tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    traces = snapshot.traces
+    return {
+        "peak_mb": round(peak / 2**20, 2),
+        "retained_mb": round(sum(trace.size for trace in traces) / 2**20, 2),
+        "retained_blocks": len(traces),
+    }
+
+@contextmanager
+def quiet_stderr():
+    # Malformed rows are logged to stderr; keep them out of the benchmark output.
+    stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+def bench_scoring(args):
+    liked = synthetic_centers(3, seed=1)
+    disliked = synthetic_centers(3, seed=2)
+    results = []
+    for size in args.sizes:
+        products = synthetic_catalog(size)
+        with quiet_stderr():
+            row = {"catalog_size": size}
+            row["vectorized"] = summarize(time_call(
+                lambda: recommendation.recommend_products(liked, disliked, products), args.repeat))
+            if size <= args.legacy_max:
+                products_df = catalog_dataframe(products)
+                row["legacy"] = summarize(time_call(
+                    lambda: legacy_recommend_products(liked, disliked, products_df.copy()), max(1, args.repeat // 5)))
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+def load_encoder(model_name):
+    if not model_name:
+        return StubEncoder()
+    from model_loader import load_model
+    return load_model(model_name)
+
+def bench_encoding(args):
+    model = load_encoder(args.model)
+    texts = synthetic_descriptions(args.count)
+    results = []
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        encode_in_batches(model, texts, batch_size=batch_size, workers=args.workers)
+        elapsed = time.perf_counter() - start
+        row = {
+            "batch_size": batch_size,
+            "workers": args.workers,
+            "texts": len(texts),
+            "seconds": round(elapsed, 3),
+            "texts_per_second": round(len(texts) / elapsed, 1),
+        }
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+def bench_ann(args):
+    results = []
+    for size in args.sizes:
+        matrix, topic_centers = clustered_matrix(size)
+        start = time.perf_counter()
+        index = IVFIndex.build(matrix, n_lists=args.lists)
+        build_seconds = time.perf_counter() - start
+        users = synthetic_users(topic_centers, args.users)
+
+        exact_times, exact_tops = [], []
+        for liked, disliked in users:
+            start = time.perf_counter()
+            scores = recommendation.score_embeddings(matrix, liked, disliked)
+            exact_tops.append(set(recommendation.select_top_n(scores, args.top_n).tolist()))
+            exact_times.append(time.perf_counter() - start)
+
+        for n_probe in args.probes:
+            ann_times, recalls, candidate_counts = [], [], []
+            for (liked, disliked), exact_top in zip(users, exact_tops):
+                start = time.perf_counter()
+                rows = index.candidates(liked, n_probe=n_probe)
+                scores = recommendation.score_embeddings(matrix[rows], liked, disliked)
+                ann_top = rows[recommendation.select_top_n(scores, args.top_n)]
+                ann_times.append(time.perf_counter() - start)
+                recalls.append(len(exact_top.intersection(ann_top.tolist())) / args.top_n)
+                candidate_counts.append(len(rows))
+            row = {
+                "catalog_size": size,
+                "lists": index.n_lists,
+                "n_probe": n_probe,
+                "build_seconds": round(build_seconds, 2),
+                f"recall@{args.top_n}": round(float(np.mean(recalls)), 4),
+                "mean_candidates": int(np.mean(candidate_counts)),
+                "exact": summarize(exact_times),
+                "ann": summarize(ann_times),
+            }
+            results.append(row)
+            print(json.dumps(row))
+    return results
+
+def float64_scores(matrix, liked, disliked, dislike_weight=1.0):
+    """
+    Reference scores at float64, as the original sklearn cosine_similarity path computed them.
+    """
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float64)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    normalized = normalize(matrix)
+    scores = (normalized @ normalize(liked).T).max(axis=1)
+    if disliked is not None and len(disliked):
+        scores -= dislike_weight * (normalized @ normalize(disliked).T).max(axis=1)
+    return scores
+
+def bench_quantization(args):
+    """
+    Ranking agreement of float16 / int8 scoring (with and without an exact float32
+    rerank) against the float64 reference, plus latency and bytes per product.
+    """
+    results = []
+    for size in args.sizes:
+        matrix, topic_centers = clustered_matrix(size)
+        users = synthetic_users(topic_centers, args.users)
+        references = []
+        for liked, disliked in users:
+            scores = float64_scores(matrix, liked, disliked)
+            references.append((recommendation.select_top_n(scores, args.top_n), scores))
+        for precision in PRECISIONS:
+            quantized = QuantizedMatrix.from_matrix(matrix, precision)
+            for rerank in args.reranks:
+                timings, recalls, same_order, score_errors = [], [], [], []
+                for (liked, disliked), (reference_top, reference_scores) in zip(users, references):
+                    start = time.perf_counter()
+                    scores = quantized.score(liked, disliked)
+                    top = recommendation.select_top_n(scores, max(rerank, args.top_n))
+                    if rerank:
+                        exact = recommendation.score_embeddings(matrix[top], liked, disliked)
+                        order = recommendation.select_top_n(exact, args.top_n)
+                        top, top_scores = top[order], exact[order]
+                    else:
+                        top = top[:args.top_n]
+                        top_scores = scores[top]
+                    timings.append(time.perf_counter() - start)
+                    recalls.append(len(np.intersect1d(top, reference_top)) / args.top_n)
+                    same_order.append(float(np.array_equal(top, reference_top)))
+                    score_errors.append(float(np.abs(top_scores - reference_scores[top]).max()))
+                row = {
+                    "catalog_size": size,
+                    "precision": precision,
+                    "rerank": rerank,
+                    "bytes_per_product": round(quantized.nbytes / size, 1),
+                    f"recall@{args.top_n}": round(float(np.mean(recalls)), 4),
+                    "identical_order": round(float(np.mean(same_order)), 4),
+                    "max_score_error": float(np.max(score_errors)),
+                    **summarize(timings),
+                }
+                results.append(row)
+                print(json.dumps(row))
+    return results
+
+def bench_sharding(args):
+    """
+    Throughput of the sharded scoring paths versus the number of worker threads:
+    one user against the whole store (float32, and int8 with rerank) and a batch of
+    users through recommend_batch. speedup is relative to the first --workers value.
+    """
+    results = []
+    for size in args.sizes:
+        matrix, topic_centers = clustered_matrix(size)
+        users = synthetic_users(topic_centers, max(args.batch_users, 1))
+        with tempfile.TemporaryDirectory() as directory:
+            store = EmbeddingStore(directory)
+            store.add_posts([{"_id": str(i), "embedding": row} for i, row in enumerate(matrix)], None)
+            del matrix
+            quantized = quantization.load_or_build(store, "int8")
+            batch = [{"liked": liked, "disliked": disliked} for liked, disliked in users[:args.batch_users]]
+            liked, disliked = users[0]
+            cases = {
+                "store_float32": lambda workers: recommendation.recommend_from_store(
+                    store, liked, disliked, top_n=args.top_n, workers=workers),
+                "store_int8": lambda workers: recommendation.recommend_from_store(
+                    store, liked, disliked, top_n=args.top_n, quantized=quantized, rerank=100, workers=workers),
+                "batch": lambda workers: recommendation.recommend_batch(
+                    store.matrix, batch, args.top_n, workers=workers),
+            }
+            for case, func in cases.items():
+                baseline = None
+                for workers in args.workers:
+                    func(workers)  # warm-up, also starts the pool threads
+                    timings = time_call(lambda: func(workers), args.repeat)
+                    mean = float(np.mean(timings))
+                    baseline = baseline or mean
+                    scored = size * (len(batch) if case == "batch" else 1)
+                    row = {
+                        "case": case,
+                        "catalog_size": size,
+                        "workers": workers,
+                        "cpus": os.cpu_count(),
+                        **summarize(timings),
+                        "rows_per_second": round(scored / mean, 1),
+                        "speedup": round(baseline / mean, 2),
+                    }
+                    results.append(row)
+                    print(json.dumps(row))
+                    sys.stdout.flush()
+    return results
+
+EMBEDDING_FORMATS = ("list", "string", "missing")
+
+def synthetic_posts(num_products, embedding_format, dim=EMBEDDING_DIM, seed=0):
+    """
+    Posts as the Node job sends them. embedding_format is "list" (a JSON array),
+    "string" (the array serialized into a string, as older documents store it) or
+    "missing" (no embedding, so every description has to be encoded).
+    """
+    matrix, _ = clustered_matrix(num_products, dim, seed=seed)
+    descriptions = synthetic_descriptions(num_products, min_words=5, max_words=30, seed=seed)
+    posts = []
+    for i in range(num_products):
+        post = {"_id": f"post-{i}", "description": descriptions[i]}
+        if embedding_format == "list":
+            post["embedding"] = np.round(matrix[i], 6).tolist()
+        elif embedding_format == "string":
+            post["embedding"] = json.dumps(np.round(matrix[i], 6).tolist())
+        posts.append(post)
+    return posts
+
+def user_profiles(histories, seed=5):
+    """
+    One synthetic user per (liked, disliked) history size: the descriptions they
+    swiped, which calculate_preferences turns into their cluster centers.
+    """
+    profiles = []
+    for i, (liked, disliked) in enumerate(histories):
+        profiles.append({
+            "history": f"{liked}/{disliked}",
+            "liked": synthetic_descriptions(liked, seed=seed + 2 * i),
+            "disliked": synthetic_descriptions(disliked, seed=seed + 2 * i + 1),
+        })
+    return profiles
+
+def measure(stage, rows, func, repeat, memory=True, **labels):
+    func()  # warm-up
+    timings = time_call(func, repeat)
+    row = {"stage": stage, **labels, "rows": rows, "repeat": repeat, **summarize(timings)}
+    row["rows_per_second"] = round(rows / float(np.mean(timings)), 1) if rows else None
+    row["peak_mb"] = peak_traced_mb(func) if memory else None
+    print(json.dumps(row))
+    sys.stdout.flush()
+    return row
+
+def bench_pipeline(args):
+    """
+    Latency percentiles, throughput and peak allocated memory of each stage a
+    /recommend and /calculate_preferences request goes through, using the offline
+    stub encoder.
+    """
+    encoder = StubEncoder(call_overhead=args.stub_overhead_ms / 1000.0, token_cost=args.stub_token_us / 1e6)
+    # calculate_preferences encodes through calculatePreferences' global model and the shared cache.
+    calculatePreferences.model = encoder
+    histories = [tuple(int(n) for n in history.split("/")) for history in args.histories]
+    results = []
+    users = []
+    run = 0
+
+    for profile in user_profiles(histories):
+        def cluster(profile=profile):
+            nonlocal run
+            run += 1
+            # A new model name gives an empty embedding cache, so every run really encodes.
+            name = f"benchmark-stub-{run}"
+            clusters = calculatePreferences.calculate_preferences(
+                {"likedDescriptions": profile["liked"], "dislikedDescriptions": profile["disliked"]}, model_name=name)
+            return clusters["likedClusters"], clusters["dislikedClusters"]
+        with quiet_stderr():
+            results.append(measure("calculate_preferences", len(profile["liked"]) + len(profile["disliked"]),
+                                   cluster, args.repeat, history=profile["history"]))
+            liked, disliked = cluster()
+        users.append((profile["history"], np.array(liked), np.array(disliked) if disliked else None))
+
+    for size in args.sizes:
+        for embedding_format in args.formats:
+            posts = synthetic_posts(size, embedding_format)
+            payload = json.dumps({"likedClusters": users[0][1].tolist(), "posts": posts})
+            labels = {"catalog_size": size, "embedding_format": embedding_format}
+            results.append(measure("parse_json", size, lambda: json.loads(payload), args.repeat,
+                                   payload_mb=round(len(payload) / 2**20, 2), **labels))
+            del payload
+
+            # Embeddings encoded by the stub are not cached between runs either.
+            build = lambda: recommendation.get_product_batch(posts, encoder, cache=EmbeddingCache(max_entries=0))
+            with quiet_stderr():
+                results.append(measure("get_product_batch", size, build, args.repeat, **labels))
+                products = build()
+            del posts
+
+            for history, liked, disliked in users:
+                score = lambda: recommendation.recommend_products(liked, disliked, products, top_n=30)
+                results.append(measure("recommend_products", size, score, args.repeat,
+                                       history=history, **labels))
+            top = recommendation.recommend_products(users[0][1], users[0][2], products, top_n=30)
+            results.append(measure("serialize", len(top), lambda: json.dumps(top), args.repeat, **labels))
+    return results
+
+def bench_products(args):
+    """
+    Latency, peak memory and the allocations left behind by parsing posts and
+    recommending from them, with the DataFrame representation (legacy) and with
+    ProductBatch (batch). Posts carry embeddings, so no encoding is timed.
+    """
+    liked = synthetic_centers(3, seed=1)
+    disliked = synthetic_centers(3, seed=2)
+    cases = {
+        "legacy": (lambda posts: legacy_products_dataframe(posts, None),
+                   lambda products: legacy_dataframe_recommend(liked, disliked, products, args.top_n)),
+        "batch": (lambda posts: recommendation.get_product_batch(posts, None),
+                  lambda products: recommendation.recommend_products(liked, disliked, products, top_n=args.top_n)),
+    }
+    results = []
+    for size in args.sizes:
+        for embedding_format in args.formats:
+            posts = synthetic_posts(size, embedding_format)
+            for case, (build, recommend) in cases.items():
+                labels = {"case": case, "catalog_size": size, "embedding_format": embedding_format}
+                products = build(posts)
+                for stage_name, func in (("build", lambda: build(posts)),
+                                         ("recommend", lambda: recommend(products)),
+                                         ("request", lambda: recommend(build(posts)))):
+                    func()  # warm-up
+                    timings = time_call(func, args.repeat)
+                    row = {"stage": stage_name, **labels, "rows": size, "repeat": args.repeat, **summarize(timings),
+                           **traced_allocations(func)}
+                    results.append(row)
+                    print(json.dumps(row))
+                    sys.stdout.flush()
+                del products
+    return results
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def cold_start_cases(args):
+    """
+    (name, argv, stdin, extra env) for each process start measured by bench_coldstart.
+    """
+    tiny_request = json.dumps({"likedDescriptions": ["a red wool scarf", "a blue cotton shirt"],
+                               "dislikedDescriptions": ["a garden hose"]}).encode("utf-8")
+    cases = [
+        ("import_recommendation", ["-c", "import recommendation"], b"", {}),
+        ("import_calculatePreferences", ["-c", "import calculatePreferences"], b"", {}),
+        # Requests rejected before any model is needed.
+        ("recommendation_invalid_request", ["recommendation.py"], b"{}", {}),
+        ("calculatePreferences_empty_input", ["calculatePreferences.py"], b"", {}),
+    ]
+    if args.with_model:
+        variants = [("hub", {"MODEL_SNAPSHOT_DIR": ""})]
+        if args.snapshot_dir:
+            variants.append(("snapshot", {"MODEL_SNAPSHOT_DIR": args.snapshot_dir}))
+            variants.append(("snapshot_qint8", {"MODEL_SNAPSHOT_DIR": args.snapshot_dir, "MODEL_QUANTIZED": "1"}))
+        for variant, env in variants:
+            cases.append((f"load_model_{variant}", ["-c", "import model_loader; model_loader.load_model()"], b"", env))
+            cases.append((f"calculatePreferences_{variant}", ["calculatePreferences.py"], tiny_request, env))
+    return cases
+
+def bench_coldstart(args):
+    """
+    Wall time of fresh Python processes, as spawned per request by the Node side:
+    imports alone, requests that fail validation, and (with --with-model) model
+    loading from the hub cache or from a local snapshot.
+    """
+    results = []
+    for name, argv, stdin, extra_env in cold_start_cases(args):
+        env = dict(os.environ, STAGE_LOG="0", **extra_env)
+        timings, exit_codes = [], set()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, *argv], input=stdin, capture_output=True, cwd=HERE, env=env)
+            timings.append(time.perf_counter() - start)
+            exit_codes.add(proc.returncode)
+        row = {"stage": "cold_start", "case": name, "repeat": args.repeat,
+               "exit_codes": sorted(exit_codes), **summarize(timings)}
+        results.append(row)
+        print(json.dumps(row))
+        sys.stdout.flush()
+    return results
+
+def run_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "argv": sys.argv[1:],
+    }
+
+def result_key(row):
+    return tuple((key, row[key]) for key in ("stage", "case", "catalog_size", "embedding_format", "history",
+                                             "batch_size", "workers", "n_probe", "precision", "rerank") if key in row)
+
+def bench_compare(args):
+    """
+    p50 latency and peak memory of each measurement in NEW relative to BASE.
+    """
+    with open(args.base) as f:
+        base = {result_key(row): row for row in json.load(f)["results"]}
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+    results = []
+    for row in new:
+        before = base.get(result_key(row))
+        if before is None or "p50_ms" not in row or "p50_ms" not in before:
+            continue
+        comparison = dict(result_key(row))
+        comparison.update({
+            "base_p50_ms": before["p50_ms"],
+            "new_p50_ms": row["p50_ms"],
+            "p50_change": round(row["p50_ms"] / before["p50_ms"] - 1, 4) if before["p50_ms"] else None,
+        })
+        if before.get("peak_mb") and row.get("peak_mb") is not None:
+            comparison["peak_mb_change"] = round(row["peak_mb"] / before["peak_mb"] - 1, 4)
+        if before.get("retained_blocks") and row.get("retained_blocks") is not None:
+            comparison["retained_blocks_change"] = round(row["retained_blocks"] / before["retained_blocks"] - 1, 4)
+        results.append(comparison)
+        print(json.dumps(comparison))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommendation pipeline benchmarks")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", default=None,
+                        help="also write the results and run metadata to this JSON file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scoring = subparsers.add_parser("scoring", parents=[common], help="recommend_products latency versus catalog size")
+    scoring.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000])
+    scoring.add_argument("--repeat", type=int, default=10)
+    scoring.add_argument("--legacy-max", type=int, default=10000,
+                         help="largest catalog to run the old iterrows implementation on")
+    scoring.set_defaults(func=bench_scoring)
+
+    encoding = subparsers.add_parser("encoding", parents=[common], help="description encoding throughput versus batch size")
+    encoding.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64, 128, 256])
+    encoding.add_argument("--count", type=int, default=2048, help="number of descriptions to encode")
+    encoding.add_argument("--workers", type=int, default=1)
+    encoding.add_argument("--model", default=None,
+                          help="SentenceTransformer model to load; defaults to an offline stub encoder")
+    encoding.set_defaults(func=bench_encoding)
+
+    ann = subparsers.add_parser("ann", parents=[common], help="IVF retrieval recall and latency against the exact scan")
+    ann.add_argument("--sizes", type=int, nargs="+", default=[100000])
+    ann.add_argument("--lists", type=int, default=None)
+    ann.add_argument("--probes", type=int, nargs="+", default=[2, 4, 8, 16])
+    ann.add_argument("--users", type=int, default=50)
+    ann.add_argument("--top-n", type=int, default=30)
+    ann.set_defaults(func=bench_ann)
+
+    quantization = subparsers.add_parser("quantization", parents=[common],
+                                         help="float16/int8 scoring agreement with float64, with and without rerank")
+    quantization.add_argument("--sizes", type=int, nargs="+", default=[100000])
+    quantization.add_argument("--reranks", type=int, nargs="+", default=[0, 100])
+    quantization.add_argument("--users", type=int, default=50)
+    quantization.add_argument("--top-n", type=int, default=30)
+    quantization.set_defaults(func=bench_quantization)
+
+    sharding = subparsers.add_parser("sharding", parents=[common],
+                                     help="sharded scoring throughput versus worker threads")
+    sharding.add_argument("--sizes", type=int, nargs="+", default=[200000])
+    sharding.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    sharding.add_argument("--batch-users", type=int, default=16)
+    sharding.add_argument("--repeat", type=int, default=10)
+    sharding.add_argument("--top-n", type=int, default=30)
+    sharding.set_defaults(func=bench_sharding)
+
+    products = subparsers.add_parser("products", parents=[common],
+                                     help="peak memory and allocations of the DataFrame versus ProductBatch posts path")
+    products.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    products.add_argument("--formats", nargs="+", choices=("list", "string"), default=["list"])
+    products.add_argument("--repeat", type=int, default=5)
+    products.add_argument("--top-n", type=int, default=30)
+    products.set_defaults(func=bench_products)
+
+    pipeline = subparsers.add_parser("pipeline", parents=[common], help="per-stage latency, throughput and peak memory on synthetic requests")
+    pipeline.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                          help="catalog sizes (up to 500000; list and string posts need several GB at that size)")
+    pipeline.add_argument("--formats", nargs="+", choices=EMBEDDING_FORMATS, default=list(EMBEDDING_FORMATS))
+    pipeline.add_argument("--histories", nargs="+", default=["5/0", "50/20", "500/200"],
+                          help="liked/disliked history sizes of the synthetic users")
+    pipeline.add_argument("--repeat", type=int, default=5)
+    pipeline.add_argument("--stub-overhead-ms", type=float, default=3.0,
+                          help="stub encoder cost per model.encode call")
+    pipeline.add_argument("--stub-token-us", type=float, default=20.0,
+                          help="stub encoder cost per padded token")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    coldstart = subparsers.add_parser("coldstart", parents=[common], help="start-up time of the per-request CLI processes")
+    coldstart.add_argument("--repeat", type=int, default=5)
+    coldstart.add_argument("--with-model", action="store_true",
+                           help="also time model loading and a small calculatePreferences request (needs the model)")
+    coldstart.add_argument("--snapshot-dir", default=None,
+                           help="directory written by `model_loader.py snapshot` to compare against the hub")
+    coldstart.set_defaults(func=bench_coldstart)
+
+    compare = subparsers.add_parser("compare", parents=[common], help="compare two --output files")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": run_metadata(), "command": args.command, "results": results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -99,11 +99,18 @@ if __name__ == "__main__":
     main()
 '''
 #!/usr/bin/env python3
+import os
 import sys
 import json
+import time
+import argparse
 import numpy as np
-from sklearn.cluster import KMeans
-from sentence_transformers import SentenceTransformer
+
+from embedding_cache import get_embedding_cache
+from model_loader import load_model
+from wire_format import WIRE_FORMATS, decode_vectors, encode_vectors, is_blob
+from instrumentation import PROFILERS, payload_summary, profiled, stage
+from parallel_scoring import map_parallel
 
 # Global model variable
 model = None
@@ -114,54 +121,390 @@ def get_model(model_name="all-MiniLM-L6-v2"):
         try:
             sys.stderr.write("Loading SentenceTransformer model...\n")
             sys.stderr.flush()
-            model = SentenceTransformer(model_name)
+            with stage("load_model"):
+                model = load_model(model_name)
         except Exception as e:
             sys.stderr.write(f"Error loading model: {e}\n")
             sys.stderr.flush()
             raise
     return model
 
-def cluster_descriptions(descriptions, num_clusters=None, model_name="all-MiniLM-L6-v2"):
-    if not descriptions:
-        return []
+DEFAULT_NUM_CLUSTERS = 3
+SIDES = ("liked", "disliked")
+# Threads fitting users' clusters in calculate_preferences_batch (0: one per CPU).
+CLUSTER_WORKERS = int(os.environ.get("CLUSTER_WORKERS", "1"))
+# "fixed": DEFAULT_NUM_CLUSTERS centers per side; "adaptive": see fit_adaptive.
+CLUSTER_MODES = ("fixed", "adaptive")
+CLUSTER_MODE = os.environ.get("CLUSTER_MODE", "fixed")
+# Adaptive mode: k is chosen from 1..ADAPTIVE_MAX_CLUSTERS with at least
+# POINTS_PER_CLUSTER descriptions per center.
+ADAPTIVE_MAX_CLUSTERS = 8
+POINTS_PER_CLUSTER = 5
+# Wall time one side's search may take; k values not reached are skipped.
+CLUSTER_TIME_BUDGET = float(os.environ.get("CLUSTER_TIME_BUDGET", "0.25"))
+ADAPTIVE_MAX_ITER = 50
+# Points used to compute each silhouette score.
+SILHOUETTE_SAMPLE = 1000
+# Above this many descriptions, MiniBatchKMeans replaces KMeans.
+MINIBATCH_THRESHOLD = 2000
+MINIBATCH_SIZE = 1024
+
+def encode_descriptions(descriptions, model_name="all-MiniLM-L6-v2"):
     try:
         model_instance = get_model(model_name)
     except Exception as e:
         sys.stderr.write(f"Error obtaining model: {e}\n")
         sys.stderr.flush()
         raise
-    sys.stderr.write(f"Clustering {len(descriptions)} descriptions\n")
-    sys.stderr.flush()
     try:
-        embeddings = model_instance.encode(descriptions)
+        # Repeated descriptions (e.g. weighted favourites) are encoded only once.
+        return get_embedding_cache(model_name).encode(model_instance, descriptions)
     except Exception as e:
         sys.stderr.write(f"Error encoding descriptions: {e}\n")
         sys.stderr.flush()
         raise
+
+def as_weights(weights, count):
+    """
+    Per-description weights as a float array, or None for uniform weighting.
+    """
+    if weights is None:
+        return None
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape != (count,) or not np.isfinite(weights).all() or (weights < 0).any():
+        raise ValueError(f"expected {count} finite, non-negative weights")
+    return weights
+
+def fit_clusters(embeddings, weights=None, num_clusters=None):
+    """
+    Weighted KMeans fit. Returns (centers, counts) where counts is the total weight
+    assigned to each center.
+    """
+    from sklearn.cluster import KMeans
     if num_clusters is None:
-        num_clusters = min(3, len(embeddings))
-    try:
-        kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-        kmeans.fit(embeddings)
-        centers = kmeans.cluster_centers_.tolist()
-    except Exception as e:
-        sys.stderr.write(f"Error during clustering: {e}\n")
+        num_clusters = min(DEFAULT_NUM_CLUSTERS, len(embeddings))
+    kmeans = KMeans(n_clusters=num_clusters, random_state=42)
+    kmeans.fit(embeddings, sample_weight=weights)
+    point_weights = weights if weights is not None else np.ones(len(embeddings))
+    counts = np.bincount(kmeans.labels_, weights=point_weights, minlength=num_clusters)
+    return kmeans.cluster_centers_, counts
+
+def _fit_kmeans(embeddings, weights, k, init=None):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    init = init if init is not None else "k-means++"
+    if len(embeddings) > MINIBATCH_THRESHOLD:
+        model = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, max_iter=ADAPTIVE_MAX_ITER,
+                                batch_size=MINIBATCH_SIZE, random_state=42)
+    else:
+        model = KMeans(n_clusters=k, init=init, n_init=1, max_iter=ADAPTIVE_MAX_ITER, random_state=42)
+    model.fit(embeddings, sample_weight=weights)
+    return model
+
+def fit_adaptive(embeddings, weights=None, previous=None, time_budget=None):
+    """
+    Weighted clustering with the number of centers chosen per user: every k from 2
+    up to min(ADAPTIVE_MAX_CLUSTERS, len / POINTS_PER_CLUSTER) is fitted with a
+    single initialisation and scored by (sampled, unweighted) silhouette, and the
+    best k wins. Too few descriptions for two such clusters give one center.
+    The previous centers, when given, warm-start the fit with their own k, which is
+    tried first, followed by DEFAULT_NUM_CLUSTERS; once time_budget seconds
+    (default CLUSTER_TIME_BUDGET) have passed no further k is tried. Above
+    MINIBATCH_THRESHOLD descriptions MiniBatchKMeans is used. Returns (centers, counts)
+    like fit_clusters.
+    """
+    from sklearn.metrics import silhouette_score
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    point_weights = weights if weights is not None else np.ones(len(embeddings))
+    single = lambda: (
+        np.average(embeddings, axis=0, weights=point_weights if point_weights.sum() > 0 else None)[None, :],
+        np.array([point_weights.sum()]),
+    )
+    k_max = min(ADAPTIVE_MAX_CLUSTERS, len(embeddings) // POINTS_PER_CLUSTER, len(embeddings) - 1)
+    if k_max < 2:
+        return single()
+
+    if previous is not None:
+        previous = np.asarray(previous, dtype=np.float64)
+        if previous.ndim != 2 or previous.shape[1] != embeddings.shape[1] or not 2 <= len(previous) <= k_max:
+            previous = None
+    candidates = [len(previous)] if previous is not None else []
+    candidates += [k for k in [DEFAULT_NUM_CLUSTERS] + list(range(2, k_max + 1))
+                   if k <= k_max and k not in candidates]
+
+    budget = CLUSTER_TIME_BUDGET if time_budget is None else time_budget
+    deadline = time.perf_counter() + budget
+    best, best_score = None, -np.inf
+    for k in candidates:
+        if best is not None and time.perf_counter() > deadline:
+            break
+        model = _fit_kmeans(embeddings, weights, k, previous if previous is not None and k == len(previous) else None)
+        if len(np.unique(model.labels_)) < 2:
+            continue
+        score = silhouette_score(embeddings, model.labels_, sample_size=min(len(embeddings), SILHOUETTE_SAMPLE),
+                                 random_state=42)
+        if score > best_score:
+            best, best_score = model, score
+    if best is None:
+        # Every fit collapsed to one cluster (e.g. identical descriptions).
+        return single()
+    counts = np.bincount(best.labels_, weights=point_weights, minlength=best.n_clusters)
+    return best.cluster_centers_, counts
+
+def update_cluster_state(state, embeddings, weights=None, num_clusters=DEFAULT_NUM_CLUSTERS, adaptive=False):
+    """
+    Fold new embeddings into a cluster state {"centers": [...], "counts": [...]} with
+    online (sequential) k-means: each point moves its nearest center toward itself
+    by weight / (new total weight of that center). While there are fewer than
+    num_clusters centers, a new point starts a center of its own.
+    A missing or empty state is initialised with a full weighted KMeans fit, or
+    with fit_adaptive when adaptive is set, whose k then stays fixed.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(embeddings))
+    if not state or not state.get("centers"):
+        if adaptive:
+            centers, counts = fit_adaptive(embeddings, weights)
+        else:
+            centers, counts = fit_clusters(embeddings, weights, min(num_clusters, len(embeddings)))
+        return {"centers": centers.tolist(), "counts": counts.tolist()}
+
+    stored = state["centers"]
+    if is_blob(stored):
+        stored = decode_vectors(stored)
+    centers = [np.asarray(center, dtype=np.float64) for center in stored]
+    counts = [float(count) for count in state.get("counts") or [1.0] * len(centers)]
+    if len(counts) != len(centers):
+        raise ValueError("cluster state has a different number of centers and counts")
+    if adaptive:
+        num_clusters = len(centers)
+    for point, weight in zip(embeddings, weights):
+        if weight <= 0:
+            continue
+        if len(centers) < num_clusters:
+            centers.append(point.copy())
+            counts.append(float(weight))
+            continue
+        nearest = int(np.argmin(((np.stack(centers) - point) ** 2).sum(axis=1)))
+        counts[nearest] += weight
+        centers[nearest] += (weight / counts[nearest]) * (point - centers[nearest])
+    return {"centers": [center.tolist() for center in centers], "counts": counts}
+
+def check_wire_format(wire_format):
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError(f"unknown wireFormat {wire_format!r}; expected one of {', '.join(WIRE_FORMATS)}")
+    return wire_format
+
+def side_descriptions(data, side):
+    descriptions = data.get(f"{side}Descriptions") or []
+    if not isinstance(descriptions, list) or not all(isinstance(text, str) for text in descriptions):
+        raise ValueError(f"{side}Descriptions must be a list of strings")
+    return descriptions
+
+def check_cluster_mode(cluster_mode):
+    if cluster_mode not in CLUSTER_MODES:
+        raise ValueError(f"unknown clusterMode {cluster_mode!r}; expected one of {', '.join(CLUSTER_MODES)}")
+    return cluster_mode
+
+def preferences_from_embeddings(data, embeddings, wire_format="json", cluster_mode=None):
+    """
+    The calculate_preferences output for a request whose descriptions are already
+    encoded: embeddings maps "liked"/"disliked" to one row per description.
+    An error on one side is logged and leaves its clusters empty.
+    """
+    adaptive = check_cluster_mode(data.get("clusterMode") or cluster_mode or CLUSTER_MODE) == "adaptive"
+    output = {}
+    for side in SIDES:
+        descriptions = data.get(f"{side}Descriptions") or []
+        state_key = f"{side}State"
+        try:
+            weights = as_weights(data.get(f"{side}Weights"), len(descriptions))
+            if state_key in data:
+                state = data.get(state_key) or {"centers": [], "counts": []}
+                if descriptions:
+                    state = update_cluster_state(state, embeddings[side], weights, adaptive=adaptive)
+                if state["centers"] and not is_blob(state["centers"]):
+                    state = dict(state, centers=encode_vectors(state["centers"], wire_format))
+                output[state_key] = state
+                centers = state["centers"]
+            elif not descriptions:
+                centers = []
+            elif adaptive:
+                previous = data.get(f"{side}PreviousClusters")
+                previous = decode_vectors(previous) if previous else None
+                centers = fit_adaptive(embeddings[side], weights, previous)[0].tolist()
+            else:
+                centers = fit_clusters(embeddings[side], weights)[0].tolist()
+        except Exception as e:
+            sys.stderr.write(f"Error clustering {side} descriptions: {e}\n")
+            sys.stderr.flush()
+            centers = []
+        if len(centers) and not is_blob(centers):
+            centers = encode_vectors(centers, wire_format)
+        output[f"{side}Clusters"] = centers
+    return output
+
+def calculate_preferences(data, model_name="all-MiniLM-L6-v2", wire_format=None):
+    """
+    Compute {"likedClusters", "dislikedClusters"} for one request. Each side reads
+    "<side>Descriptions" and optional "<side>Weights" (e.g. 10 for a favourite
+    instead of repeating it 10 times). When the request carries "<side>State"
+    (null for a first run), only the descriptions swiped since that state are sent;
+    they are folded in incrementally and the new "<side>State" is returned too.
+    Centers are returned as nested lists, or as wire_format blobs when the request
+    (or the caller) sets "wireFormat" to "float16" or "float32".
+    Both sides are encoded in one pass.
+    "clusterMode": "adaptive" (default CLUSTER_MODE) chooses the number of centers
+    per side with fit_adaptive, warm-started from "<side>PreviousClusters" if sent.
+    """
+    wire_format = check_wire_format(wire_format or data.get("wireFormat") or "json")
+    check_cluster_mode(data.get("clusterMode") or CLUSTER_MODE)
+    descriptions = {}
+    for side in SIDES:
+        try:
+            descriptions[side] = side_descriptions(data, side)
+        except ValueError as e:
+            sys.stderr.write(f"Error clustering {side} descriptions: {e}\n")
+            descriptions[side] = []
+    embeddings = {side: np.zeros((0, 0), dtype=np.float32) for side in SIDES}
+    texts = descriptions["liked"] + descriptions["disliked"]
+    if texts:
+        sys.stderr.write(f"Encoding {len(texts)} descriptions\n")
         sys.stderr.flush()
-        raise
-    return centers
+        try:
+            encoded = encode_descriptions(texts, model_name)
+            split = len(descriptions["liked"])
+            embeddings = {"liked": encoded[:split], "disliked": encoded[split:]}
+        except Exception:
+            # Encode each side alone, so a failure only empties its own clusters.
+            for side in SIDES:
+                try:
+                    if descriptions[side]:
+                        embeddings[side] = encode_descriptions(descriptions[side], model_name)
+                except Exception:
+                    descriptions[side] = []
+    return preferences_from_embeddings(dict(data, **{f"{side}Descriptions": descriptions[side] for side in SIDES}),
+                                       embeddings, wire_format)
+
+def calculate_preferences_batch(data, model_name="all-MiniLM-L6-v2", wire_format=None, workers=None):
+    """
+    calculate_preferences for every user in {"users": [{userId, likedDescriptions,
+    dislikedDescriptions, likedWeights?, likedState?, ...}], "wireFormat"?}.
+    The descriptions of all users are encoded in one pass, each distinct text once,
+    and the users' clusters are then fitted on `workers` threads (default
+    CLUSTER_WORKERS). Returns [{userId, likedClusters, dislikedClusters, ...}] in
+    request order; a user whose input is unusable gets {userId, error, details}.
+    If the single pass fails, each user is encoded alone, and only the users with a
+    description that cannot be encoded get an error (their saved clusters stay valid).
+    A top-level "clusterMode" applies to users that do not set their own.
+    """
+    users = data.get("users")
+    if not isinstance(users, list):
+        raise ValueError("users must be a list")
+    wire_format = check_wire_format(wire_format or data.get("wireFormat") or "json")
+    cluster_mode = check_cluster_mode(data.get("clusterMode") or CLUSTER_MODE)
+    results = [None] * len(users)
+    texts, jobs = [], []
+    for i, user in enumerate(users):
+        user_id = user.get("userId") if isinstance(user, dict) else None
+        try:
+            if not isinstance(user, dict):
+                raise ValueError("each user must be an object")
+            descriptions = {side: side_descriptions(user, side) for side in SIDES}
+            check_cluster_mode(user.get("clusterMode") or cluster_mode)
+        except ValueError as e:
+            results[i] = {"userId": user_id, "error": "Invalid user", "details": str(e)}
+            continue
+        spans = {}
+        for side in SIDES:
+            spans[side] = (len(texts), len(descriptions[side]))
+            texts.extend(descriptions[side])
+        jobs.append((i, spans))
+
+    with stage("encode_descriptions", rows=len(texts)) as record:
+        record["unique"] = len(set(texts))
+        try:
+            encoded = encode_descriptions(texts, model_name) if texts else np.zeros((0, 0), dtype=np.float32)
+            blocks = {i: (encoded, 0) for i, _ in jobs}
+        except Exception:
+            # The vectors that were encoded are cached, so this only re-encodes the failures.
+            blocks = {}
+            for i, spans in jobs:
+                start = spans["liked"][0]
+                end = spans["disliked"][0] + spans["disliked"][1]
+                try:
+                    blocks[i] = (encode_descriptions(texts[start:end], model_name), start)
+                except Exception as e:
+                    results[i] = {"userId": users[i].get("userId"), "error": "Error encoding descriptions",
+                                  "details": str(e)}
+            record["failed_users"] = len(jobs) - len(blocks)
+            jobs = [job for job in jobs if job[0] in blocks]
+
+    def fit(job):
+        i, spans = job
+        block, offset = blocks[i]
+        embeddings = {side: block[start - offset:start - offset + count] for side, (start, count) in spans.items()}
+        return {"userId": users[i].get("userId"),
+                **preferences_from_embeddings(users[i], embeddings, wire_format, cluster_mode)}
+
+    with stage("fit_clusters", rows=len(jobs)):
+        for (i, _), output in zip(jobs, map_parallel(fit, jobs, workers if workers is not None else CLUSTER_WORKERS)):
+            results[i] = output
+    return results
 
 def main():
+    global CLUSTER_MODE
+    parser = argparse.ArgumentParser(description="Cluster liked and disliked descriptions read from stdin "
+                                                 "(one user, or {\"users\": [...]} for many)")
+    parser.add_argument("--wire-format", choices=WIRE_FORMATS, default=None,
+                        help="encoding of the output centers (default: the request's wireFormat, else json)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="threads fitting users' clusters in a multi-user request; 0 for one per CPU "
+                             "(default: CLUSTER_WORKERS env var, else 1)")
+    parser.add_argument("--cluster-mode", choices=CLUSTER_MODES, default=CLUSTER_MODE,
+                        help="fixed: DEFAULT_NUM_CLUSTERS centers per side; adaptive: choose per user "
+                             "(default: CLUSTER_MODE env var, else fixed)")
+    parser.add_argument("--profile", choices=PROFILERS, default=None,
+                        help="profile the request with cProfile or tracemalloc (default: PROFILE env var)")
+    args = parser.parse_args()
+    CLUSTER_MODE = args.cluster_mode
+    with profiled("calculate_preferences", args.profile):
+        main_request(args)
+
+def main_batch(data, args):
+    """
+    CLI handling of a multi-user request; see calculate_preferences_batch.
+    """
+    try:
+        with stage("calculate_preferences_batch", users=len(data.get("users") or [])):
+            results = calculate_preferences_batch(data, wire_format=args.wire_format, workers=args.workers)
+    except ValueError as e:
+        sys.stderr.write(f"Invalid request: {e}\n")
+        print(json.dumps({"error": "Invalid request", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    except Exception as e:
+        sys.stderr.write(f"Error computing preferences: {e}\n")
+        print(json.dumps({"error": "Error computing preferences", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    sys.stderr.write(f"Embedding cache: {json.dumps(get_embedding_cache().stats())}\n")
+    with stage("serialize", rows=len(results)):
+        print(json.dumps({"results": results}))
+    sys.stdout.flush()
+
+def main_request(args):
     try:
         # Read all input from stdin
-        input_data = sys.stdin.read()
+        with stage("read_input") as record:
+            input_data = sys.stdin.read()
+            record["bytes"] = len(input_data)
         if not input_data:
             sys.stderr.write("No input data received.\n")
             sys.stderr.flush()
             print(json.dumps({"error": "No input data received"}))
             sys.stdout.flush()
             sys.exit(1)
-        sys.stderr.write(f"Received input data: {input_data}\n")
-        sys.stderr.flush()
     except Exception as e:
         sys.stderr.write(f"Error reading input data: {e}\n")
         sys.stderr.flush()
@@ -171,39 +514,39 @@ def main():
 
     # Parse the JSON input
     try:
-        data = json.loads(input_data)
+        with stage("parse_json"):
+            data = json.loads(input_data)
     except Exception as e:
         sys.stderr.write(f"Error parsing JSON: {e}\n")
         sys.stderr.flush()
         print(json.dumps({"error": "Error parsing JSON", "details": str(e)}))
         sys.stdout.flush()
         sys.exit(1)
+    sys.stderr.write(f"Received request: {json.dumps(payload_summary(data, len(input_data)))}\n")
 
-    # Extract liked and disliked descriptions from input
-    liked_descriptions = data.get("likedDescriptions", [])
-    disliked_descriptions = data.get("dislikedDescriptions", [])
+    # A request with "users" computes every user's preferences in one pass.
+    if isinstance(data, dict) and "users" in data:
+        main_batch(data, args)
+        return
 
-    # Cluster the descriptions and catch errors separately
-    try:
-        liked_centers = cluster_descriptions(liked_descriptions) if liked_descriptions else []
-    except Exception as e:
-        sys.stderr.write(f"Error clustering liked descriptions: {e}\n")
-        sys.stderr.flush()
-        liked_centers = []
+    # Cluster the liked and disliked descriptions; errors on one side leave its clusters empty.
     try:
-        disliked_centers = cluster_descriptions(disliked_descriptions) if disliked_descriptions else []
-    except Exception as e:
-        sys.stderr.write(f"Error clustering disliked descriptions: {e}\n")
-        sys.stderr.flush()
-        disliked_centers = []
-
-    output = {"likedClusters": liked_centers, "dislikedClusters": disliked_centers}
-    sys.stderr.write(f"Output clusters: {output}\n")
+        rows = len(data.get("likedDescriptions") or []) + len(data.get("dislikedDescriptions") or [])
+        with stage("calculate_preferences", rows=rows):
+            output = calculate_preferences(data, wire_format=args.wire_format)
+    except ValueError as e:
+        sys.stderr.write(f"Invalid request: {e}\n")
+        print(json.dumps({"error": "Invalid request", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    sys.stderr.write(f"Embedding cache: {json.dumps(get_embedding_cache().stats())}\n")
+    sys.stderr.write(f"Output clusters: {json.dumps(payload_summary(output))}\n")
     sys.stderr.flush()
     
     try:
-        result = json.dumps(output)
-        print(result)
+        with stage("serialize"):
+            result = json.dumps(output)
+            print(result)
         sys.stdout.flush()  # ensure output is flushed immediately
     except Exception as e:
         sys.stderr.write(f"Error converting output to JSON: {e}\n")
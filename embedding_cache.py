@@ -0,0 +1,212 @@
+"""
+Shared cache of sentence embeddings for product descriptions.
+
+Entries are keyed by a hash of the model name, the variant of the loaded model
+(model_loader.model_variant, e.g. int8 quantized) and the whitespace-normalized text.
+Recently used vectors are kept in a bounded in-memory LRU. An optional SQLite
+file keeps them across processes and restarts. Configure the shared caches with:
+
+    EMBEDDING_CACHE_SIZE   max in-memory entries per model (default 10000, 0 disables)
+    EMBEDDING_CACHE_PATH   SQLite file for the persistent tier (unset disables)
+
+Cache misses are encoded in length-sorted batches:
+
+    ENCODE_BATCH_SIZE      texts per model.encode call (default 64)
+    ENCODE_WORKERS         threads running batches concurrently (default 1)
+"""
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from model_loader import model_variant
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", 64))
+DEFAULT_WORKERS = int(os.environ.get("ENCODE_WORKERS", 1))
+
+def normalize_text(text):
+    if not isinstance(text, str):
+        raise TypeError(f"expected a string to encode, got {type(text).__name__}")
+    return " ".join(text.split())
+
+def encode_in_batches(model, texts, batch_size=None, workers=None):
+    """
+    Encode texts with one model.encode call per batch. Texts are sorted by length first,
+    so each batch holds texts of similar length and needs little padding.
+    With workers > 1 the batches run on a thread pool.
+    Returns one float32 vector per text, or None for a text that could not be encoded.
+    """
+    batch_size = max(1, batch_size or DEFAULT_BATCH_SIZE)
+    workers = workers or DEFAULT_WORKERS
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    def run(batch):
+        items = [texts[i] for i in batch]
+        try:
+            return list(np.asarray(model.encode(items, batch_size=len(items)), dtype=np.float32))
+        except Exception as e:
+            sys.stderr.write(f"Error encoding batch of {len(items)} descriptions: {e}\n")
+        # Retry one by one so a single bad text only loses its own embedding.
+        vectors = []
+        for text in items:
+            try:
+                vectors.append(np.asarray(model.encode([text], batch_size=1), dtype=np.float32)[0])
+            except Exception as e:
+                sys.stderr.write(f"Error encoding description {text[:80]!r}: {e}\n")
+                vectors.append(None)
+        return vectors
+
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(run, batches))
+    else:
+        outputs = [run(batch) for batch in batches]
+    results = [None] * len(texts)
+    for batch, vectors in zip(batches, outputs):
+        for i, vector in zip(batch, vectors):
+            results[i] = vector
+    return results
+
+class EmbeddingCache:
+    """
+    Two-tier (memory LRU + optional SQLite) cache in front of model.encode.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, max_entries=10000, path=None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+
+    def key(self, text, model=None):
+        return self._key(normalize_text(text), model_variant(model))
+
+    def _key(self, normalized, variant=None):
+        # Quantized and float models give slightly different vectors; never mix them.
+        name = f"{self.model_name}:{variant}" if variant else self.model_name
+        return hashlib.sha256(f"{name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._memory),
+        }
+
+    def _remember(self, key, vector):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.hits += len(found)
+            remaining = [key for key in keys if key not in found]
+            if self._db is not None and remaining:
+                for start in range(0, len(remaining), 500):
+                    chunk = remaining[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        found[key] = vector
+                        self._remember(key, vector)
+                        self.disk_hits += 1
+        return found
+
+    def _store(self, entries):
+        with self._lock:
+            for key, vector in entries.items():
+                self._remember(key, vector)
+            if self._db is not None:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                        [(key, vector.tobytes()) for key, vector in entries.items()])
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    sys.stderr.write(f"Error writing embedding cache {self.path}: {e}\n")
+
+    def encode(self, model, texts, batch_size=None, workers=None, fallback=None):
+        """
+        Embed texts as a (len(texts), dim) float32 array. Each distinct text is encoded
+        at most once, and only when neither cache tier has it; misses go through
+        encode_in_batches. Texts that cannot be encoded get the fallback vector, or
+        raise ValueError when no fallback is given. Failures are not cached.
+        """
+        variant = model_variant(model)
+        keys = []
+        text_of = {}
+        for text in texts:
+            try:
+                normalized = normalize_text(text)
+            except TypeError as e:
+                if fallback is None:
+                    raise
+                sys.stderr.write(f"Error encoding description: {e}\n")
+                keys.append(None)
+                continue
+            key = self._key(normalized, variant)
+            text_of[key] = normalized
+            keys.append(key)
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        found = self._lookup(list(text_of))
+
+        missing = [key for key in text_of if key not in found]
+        if missing:
+            vectors = encode_in_batches(model, [text_of[key] for key in missing], batch_size, workers)
+            fresh = {key: vector for key, vector in zip(missing, vectors) if vector is not None}
+            with self._lock:
+                self.misses += len(missing)
+            self._store(fresh)
+            found.update(fresh)
+            if len(fresh) < len(missing) and fallback is None:
+                raise ValueError(f"Failed to encode {len(missing) - len(fresh)} of {len(missing)} texts")
+
+        vectors = [found.get(key) if key is not None else None for key in keys]
+        return np.stack([fallback if vector is None else vector for vector in vectors]).astype(np.float32, copy=False)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_embedding_cache(model_name=DEFAULT_MODEL_NAME):
+    """
+    Process-wide cache for the given model, configured from the environment.
+    """
+    with _caches_lock:
+        cache = _caches.get(model_name)
+        if cache is None:
+            cache = EmbeddingCache(
+                model_name,
+                max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+                path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+            )
+            _caches[model_name] = cache
+        return cache
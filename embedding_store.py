@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+On-disk catalog embedding store.
+
+Product embeddings are parsed (or encoded from the description) once when a
+product is added, and kept as a float32 matrix that recommendation requests
+memory-map instead of rebuilding from JSON every time. Rows are stored
+L2-normalized, so cosine scoring is a plain matrix product; products whose
+embedding has zero norm are listed in zeroRows and never match anything.
+
+    <directory>/embeddings.f32  row-major float32 matrix, one normalized row per product
+    <directory>/ids.utf8        post ids, back to back, with the end offset of each
+    <directory>/ids.offsets.i64 in an int64 array (likewise descriptions.utf8 and
+                                descriptions.offsets.i64)
+    <directory>/index.json      {"dim": ..., "rows": ..., "normalized": true, "zeroRows": [...]}
+
+All files are append-only apart from index.json, which stays small: opening a
+store memory-maps the files, and ids and descriptions are only decoded when
+read (the id -> row lookup is built the first time it is needed). Adding
+products appends to each file and then rewrites index.json, whose row count
+marks how much of the other files is complete.
+
+Stores written before rows were normalized are converted in place when opened,
+as are stores that kept ids and descriptions in index.json.
+
+Build or extend a store from a JSON list of posts (or {"posts": [...]}):
+
+    python3 embedding_store.py /var/data/catalog < posts.json
+"""
+import os
+import sys
+import json
+import operator
+import threading
+import numpy as np
+
+from embedding_cache import get_embedding_cache
+from product_batch import parse_post
+
+EMBEDDING_DIM = 384
+MATRIX_FILE = "embeddings.f32"
+INDEX_FILE = "index.json"
+IDS_COLUMN = "ids"
+DESCRIPTIONS_COLUMN = "descriptions"
+# Rows converted at a time when normalizing a store written before rows were normalized.
+NORMALIZE_CHUNK_ROWS = 65536
+
+def normalize_rows(matrix, out=None):
+    """
+    L2-normalize each row as float32, into out if given (which may be matrix itself).
+    Returns the normalized matrix and a mask of the rows with a non-zero norm; zero rows
+    (e.g. the fallback for descriptions that could not be encoded) stay zero instead of
+    turning into NaN. Every normalized copy of catalog or query vectors goes through here.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    nonzero = norms > 0
+    norms[~nonzero] = 1.0
+    return np.divide(matrix, norms[:, None], out=out), nonzero
+
+class StringColumn:
+    """
+    Read-only view of the first count strings of an append-only column on disk:
+    <name>.utf8 holds them back to back and <name>.offsets.i64 the end offset of each.
+    A string is decoded when it is accessed.
+    """
+
+    def __init__(self, data, ends):
+        self.data = data
+        self.ends = ends
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def open(cls, directory, name, count):
+        if count == 0:
+            return cls.empty()
+        ends = np.memmap(os.path.join(directory, name + ".offsets.i64"), dtype=np.int64, mode="r", shape=(count,))
+        size = int(ends[-1])
+        # An empty file cannot be memory-mapped (every string so far is empty).
+        data = (np.memmap(os.path.join(directory, name + ".utf8"), dtype=np.uint8, mode="r", shape=(size,))
+                if size else np.zeros(0, dtype=np.uint8))
+        return cls(data, ends)
+
+    @staticmethod
+    def append(directory, name, count, strings):
+        """
+        Write strings after the first count ones, dropping whatever an unfinished
+        earlier append left behind them.
+        """
+        data_path = os.path.join(directory, name + ".utf8")
+        offsets_path = os.path.join(directory, name + ".offsets.i64")
+        done = 0
+        if count:
+            done = int(np.memmap(offsets_path, dtype=np.int64, mode="r", shape=(count,))[-1])
+        encoded = [string.encode("utf-8") for string in strings]
+        ends = done + np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        with open(data_path, "ab") as f:
+            f.truncate(done)
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(encoded))
+        with open(offsets_path, "ab") as f:
+            f.truncate(count * 8)
+            f.seek(0, os.SEEK_END)
+            f.write(ends.tobytes())
+
+    def __len__(self):
+        return len(self.ends)
+
+    def _string(self, row):
+        start = int(self.ends[row - 1]) if row else 0
+        return self.data[start:int(self.ends[row])].tobytes().decode("utf-8")
+
+    def tolist(self, start=0, stop=None):
+        """
+        Strings start..stop decoded in one pass.
+        """
+        stop = len(self) if stop is None else stop
+        if start >= stop:
+            return []
+        ends = self.ends[start:stop].tolist()
+        first = int(self.ends[start - 1]) if start else 0
+        raw = self.data[first:ends[-1]].tobytes()
+        starts = [0] + [end - first for end in ends[:-1]]
+        return [raw[begin:end - first].decode("utf-8") for begin, end in zip(starts, ends)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return self.tolist(start, stop)[::step] if step > 0 else [self._string(row) for row in range(start, stop, step)]
+        row = operator.index(index)
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("string column index out of range")
+        return self._string(row)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+class EmbeddingStore:
+    """
+    Append-only store of product embeddings keyed by post id.
+    Safe to read from several threads while another thread adds products.
+    """
+
+    def __init__(self, directory, dim=EMBEDDING_DIM):
+        self.directory = directory
+        self.dim = dim
+        self.ids = StringColumn.empty()
+        self.descriptions = StringColumn.empty()
+        self.zero_rows = np.empty(0, dtype=np.intp)
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self._row_of = None
+        # Reentrant: add_posts builds the id lookup while holding it.
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @property
+    def matrix_path(self):
+        return os.path.join(self.directory, MATRIX_FILE)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    @property
+    def row_of(self):
+        """
+        Post id -> row, built from the ids column on first use.
+        """
+        if self._row_of is None:
+            with self._lock:
+                if self._row_of is None:
+                    self._row_of = {post_id: row for row, post_id in enumerate(self.ids)}
+        return self._row_of
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, post_id):
+        return str(post_id) in self.row_of
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index.get("dim", self.dim) != self.dim:
+            raise ValueError(f"store at {self.directory} has dim {index['dim']}, expected {self.dim}")
+        self.zero_rows = np.array(index.get("zeroRows", []), dtype=np.intp)
+        if "ids" in index:
+            self._convert_index(index)
+            return
+        self._map_columns(index["rows"])
+
+    def _convert_index(self, index):
+        # Stores written before ids and descriptions had their own files. The columns
+        # are written first, so an interrupted conversion is simply redone next time.
+        ids, descriptions = index["ids"], index["descriptions"]
+        sys.stderr.write(f"Moving the {len(ids)} ids and descriptions of the store at {self.directory} "
+                         f"out of {INDEX_FILE}\n")
+        StringColumn.append(self.directory, IDS_COLUMN, 0, ids)
+        StringColumn.append(self.directory, DESCRIPTIONS_COLUMN, 0, descriptions)
+        if ids and not index.get("normalized"):
+            self._normalize_in_place(len(ids))
+        self._write_index(len(ids))
+        self._map_columns(len(ids))
+
+    def _normalize_in_place(self, count):
+        # Normalizing is idempotent, so an interrupted conversion is simply redone next time.
+        sys.stderr.write(f"Normalizing {count} rows of the store at {self.directory}\n")
+        matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(count, self.dim))
+        zero_rows = []
+        for start in range(0, count, NORMALIZE_CHUNK_ROWS):
+            block = np.array(matrix[start:start + NORMALIZE_CHUNK_ROWS])
+            nonzero = normalize_rows(block, out=block)[1]
+            zero_rows.append(np.flatnonzero(~nonzero) + start)
+            matrix[start:start + len(block)] = block
+        matrix.flush()
+        del matrix
+        self.zero_rows = np.concatenate(zero_rows).astype(np.intp)
+
+    def _map_columns(self, count):
+        # Data past count rows belongs to an append whose index write never finished; ignore it.
+        if count:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+        else:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.descriptions = StringColumn.open(self.directory, DESCRIPTIONS_COLUMN, count)
+        # Assigned last: len(store) is the row count readers go by.
+        self.ids = StringColumn.open(self.directory, IDS_COLUMN, count)
+
+    def _write_index(self, count):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "dim": self.dim,
+                "rows": count,
+                "normalized": True,
+                "zeroRows": self.zero_rows.tolist(),
+            }, f)
+        os.replace(tmp_path, self.index_path)
+
+    def rows(self, post_ids):
+        """
+        Matrix rows for the given post ids, skipping ids that are not in the store.
+        """
+        rows = [self.row_of.get(str(post_id)) for post_id in post_ids]
+        return np.array([row for row in rows if row is not None], dtype=np.intp)
+
+    def add_posts(self, posts, model):
+        """
+        Add posts whose ids are not in the store yet. Embeddings supplied with the post
+        are used as is; the rest are encoded from the description in batches. A post
+        whose embedding is malformed (see product_batch.parse_post) gets a zero row,
+        which never matches, as it scores -9999 in a posts request.
+        Returns the number of products added.
+        """
+        new_ids, new_descriptions, vectors = [], [], []
+        missing = []
+        seen = set()
+        for post in posts:
+            try:
+                post_id, description, vector, usable = parse_post(post, self.dim)
+            except ValueError as e:
+                sys.stderr.write(f"Error processing post {post}: {e}\n")
+                continue
+            post_id = str(post_id) if post_id is not None else None
+            if post_id is None or post_id in self.row_of or post_id in seen:
+                continue
+            seen.add(post_id)
+            if not usable:
+                vector = np.zeros(self.dim, dtype=np.float32)
+            elif vector is None:
+                missing.append(len(vectors))
+            new_ids.append(post_id)
+            new_descriptions.append(description)
+            vectors.append(vector)
+        if not new_ids:
+            return 0
+
+        if missing:
+            encoded = get_embedding_cache().encode(
+                model,
+                [new_descriptions[i] for i in missing],
+                fallback=np.zeros(self.dim, dtype=np.float32)
+            )
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+        block = np.array(np.stack(vectors), dtype=np.float32)
+        nonzero = normalize_rows(block, out=block)[1]
+
+        with self._lock:
+            # A concurrent call may have added some of the same posts since they were checked above.
+            keep = np.array([post_id not in self.row_of for post_id in new_ids], dtype=bool)
+            if not keep.all():
+                new_ids = [post_id for post_id, kept in zip(new_ids, keep) if kept]
+                new_descriptions = [text for text, kept in zip(new_descriptions, keep) if kept]
+                block = block[keep]
+                nonzero = nonzero[keep]
+                if not new_ids:
+                    return 0
+            count = len(self.ids)
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(count * self.dim * 4)
+                f.seek(0, os.SEEK_END)
+                f.write(block.tobytes())
+            StringColumn.append(self.directory, IDS_COLUMN, count, new_ids)
+            StringColumn.append(self.directory, DESCRIPTIONS_COLUMN, count, new_descriptions)
+            if not nonzero.all():
+                self.zero_rows = np.concatenate([self.zero_rows, np.flatnonzero(~nonzero) + count])
+            self._write_index(count + len(new_ids))
+            row_of = self.row_of
+            self._map_columns(count + len(new_ids))
+            for row, post_id in enumerate(new_ids, start=count):
+                row_of[post_id] = row
+        return len(new_ids)
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: embedding_store.py STORE_DIR < posts.json\n")
+        sys.exit(2)
+    data = json.load(sys.stdin)
+    posts = data.get("posts", []) if isinstance(data, dict) else data
+    from model_loader import load_model
+    store = EmbeddingStore(sys.argv[1])
+    added = store.add_posts(posts, load_model())
+    print(json.dumps({"added": added, "total": len(store)}))
+
+if __name__ == "__main__":
+    main()
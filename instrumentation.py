@@ -0,0 +1,206 @@
+"""
+Per-stage timing and opt-in profiling for the recommendation entry points.
+
+    with stage("get_product_batch", rows=len(posts)):
+        ...
+
+Each stage records its wall time, the rows it processed and the process's peak RSS.
+The record is written to stderr as one JSON line, e.g.
+
+    {"stage": "recommend_products", "ms": 41.2, "rows": 50000, "peak_rss_mb": 612.4, "ok": true}
+
+and added to cumulative per-stage counters, which recommendation_server serves in
+Prometheus text format on GET /metrics. Configure with:
+
+    STAGE_LOG=0          do not write stage lines (counters are still kept)
+    PROFILE=cprofile     profile each request with cProfile and print the top functions
+    PROFILE=tracemalloc  trace allocations per request; print the peak and the largest
+                         allocations still held when it finishes
+    PROFILE_DIR=<dir>    also save the raw .prof / tracemalloc snapshot files there
+
+The entry points also take --profile, which overrides PROFILE.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILERS = ("cprofile", "tracemalloc")
+PROFILE = os.environ.get("PROFILE") or None
+STAGE_LOG = os.environ.get("STAGE_LOG", "1") != "0"
+
+_counters = {}
+_counters_lock = threading.Lock()
+# cProfile and tracemalloc are process-wide, so only one request is profiled at a time.
+_profile_lock = threading.Lock()
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process so far, or None where it is unavailable.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _record(name, seconds, rows, ok):
+    with _counters_lock:
+        counter = _counters.setdefault(name, {"count": 0, "errors": 0, "seconds": 0.0, "rows": 0})
+        counter["count"] += 1
+        counter["seconds"] += seconds
+        if rows is not None:
+            counter["rows"] += rows
+        if not ok:
+            counter["errors"] += 1
+
+@contextmanager
+def stage(name, rows=None, **fields):
+    """
+    Time the enclosed block as one stage. Yields the record, so a stage that only
+    learns its row count inside the block can set record["rows"].
+    """
+    record = {"stage": name, **fields}
+    if rows is not None:
+        record["rows"] = rows
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        seconds = time.perf_counter() - start
+        _record(name, seconds, record.get("rows"), ok)
+        if STAGE_LOG:
+            peak = peak_rss_bytes()
+            record.update({
+                "ms": round(seconds * 1000, 3),
+                "peak_rss_mb": round(peak / 2**20, 1) if peak is not None else None,
+                "ok": ok,
+            })
+            sys.stderr.write(json.dumps(record, default=str) + "\n")
+
+def stage_counters():
+    with _counters_lock:
+        return {name: dict(counter) for name, counter in _counters.items()}
+
+def prometheus_metrics():
+    """
+    Stage counters and peak RSS in the Prometheus text exposition format.
+    """
+    counters = stage_counters()
+    lines = []
+    for metric, key, kind, help_text in (
+        ("recommender_stage_calls_total", "count", "counter", "Times each stage ran"),
+        ("recommender_stage_errors_total", "errors", "counter", "Times each stage raised"),
+        ("recommender_stage_seconds_total", "seconds", "counter", "Wall time spent in each stage"),
+        ("recommender_stage_rows_total", "rows", "counter", "Rows processed by each stage"),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name in sorted(counters):
+            lines.append(f'{metric}{{stage="{name}"}} {counters[name][key]}')
+    peak = peak_rss_bytes()
+    if peak is not None:
+        lines.append("# HELP recommender_peak_rss_bytes Peak resident set size of the process")
+        lines.append("# TYPE recommender_peak_rss_bytes gauge")
+        lines.append(f"recommender_peak_rss_bytes {peak}")
+    return "\n".join(lines) + "\n"
+
+def payload_summary(data, num_bytes=None):
+    """
+    Sizes of a request or response instead of its contents: the length of every
+    list, string or object field (and the shape of wire_format blobs).
+    """
+    def size(value):
+        if isinstance(value, dict) and "data" in value and "shape" in value:
+            return "x".join(str(n) for n in value["shape"])
+        if isinstance(value, list) and value and isinstance(value[0], list):
+            return f"{len(value)}x{len(value[0])}"
+        if isinstance(value, (list, dict, str)):
+            return len(value)
+        return type(value).__name__
+
+    if isinstance(data, dict):
+        summary = {key: size(value) for key, value in data.items()}
+    else:
+        summary = {"items": size(data)}
+    if num_bytes is not None:
+        summary["bytes"] = num_bytes
+    return summary
+
+@contextmanager
+def profiled(name, profiler=None):
+    """
+    Profile the enclosed block with cProfile or tracemalloc when profiling is enabled
+    (profiler argument, else PROFILE). Reports go to stderr. While another request is
+    being profiled the block simply runs unprofiled.
+    """
+    profiler = profiler or PROFILE
+    if profiler not in PROFILERS or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        if profiler == "cprofile":
+            with _cprofile(name):
+                yield
+        else:
+            with _tracemalloc(name):
+                yield
+    finally:
+        _profile_lock.release()
+
+def _profile_path(name, suffix):
+    directory = os.environ.get("PROFILE_DIR")
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    safe_name = "".join(c if c.isalnum() else "_" for c in name).strip("_") or "request"
+    return os.path.join(directory, f"{safe_name}-{int(time.time() * 1000)}{suffix}")
+
+@contextmanager
+def _cprofile(name):
+    import io
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(25)
+        sys.stderr.write(f"cProfile for {name}:\n{report.getvalue()}")
+        path = _profile_path(name, ".prof")
+        if path:
+            profile.dump_stats(path)
+
+@contextmanager
+def _tracemalloc(name):
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(10)
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started:
+            tracemalloc.stop()
+        top = snapshot.statistics("lineno")[:15]
+        sys.stderr.write(f"tracemalloc for {name}: peak {peak / 2**20:.1f} MB traced\n")
+        for stat in top:
+            sys.stderr.write(f"  {stat}\n")
+        path = _profile_path(name, ".tracemalloc")
+        if path:
+            snapshot.dump(path)
@@ -68,26 +68,100 @@ async function updateUserRecommendations() {
   //updateUserRecommendations();
 //});
 const cron = require('node-cron');
+const crypto = require('crypto');
 const User = require('../models/User');
 const Post = require('../models/Post');
 const axios = require('axios');
 
 const PYTHON_SERVICE_URL = 'https://recommendation-service-70za.onrender.com';
 
-async function callCalculatePreferences(likedDescriptions, dislikedDescriptions) {
-  const payload = { likedDescriptions, dislikedDescriptions };
-  const response = await axios.post(`${PYTHON_SERVICE_URL}/calculate_preferences`, payload);
-  return response.data;
+// Identifies this exact set of posts, so the service can reuse the results it
+// computed against it for users whose clusters did not change. Covers what the
+// scorer reads from each post: its id, description and embedding.
+function catalogVersion(posts) {
+  const hash = crypto.createHash('sha1');
+  for (const post of posts) {
+    const embedding = post.embedding || [];
+    hash.update(`${post._id}\u0000${post.description || ''}\u0000${embedding.length}\u0000`);
+    // Posts created without an embedding keep the model's default []: nothing to hash.
+    if (embedding.length) hash.update(new Float64Array(embedding));
+  }
+  return hash.digest('hex');
 }
 
-async function callRecommend(likedClusters, dislikedClusters, samplePosts) {
-  const payload = { likedClusters, dislikedClusters, posts: samplePosts };
-  const response = await axios.post(`${PYTHON_SERVICE_URL}/recommend`, payload);
-  let recommendedIds = response.data;
-  if (recommendedIds.length && typeof recommendedIds[0] === 'object') {
-    recommendedIds = recommendedIds.map(item => item.id);
+const descriptionsOf = posts => posts.map(post => post.description).filter(Boolean);
+// Recommendations only need liked clusters; a user may have no dislikes at all.
+const hasClusters = user => Boolean(user.likedClusters && user.likedClusters.length);
+const postId = post => String(post && post._id ? post._id : post);
+const lastId = list => (list.length ? postId(list[list.length - 1]) : null);
+
+// The /calculate_preferences_batch entry for a user. Swipes are appended to
+// likedPosts / dislikedPosts / favouritePosts, so the saved cluster state covers a
+// prefix of each list and only the posts after it are sent with the state. The
+// prefix still matches while the post it ended with is at the same position: a
+// removal before it (e.g. a like that became a favourite) shifts it, even when a
+// new swipe keeps the length unchanged. Without a state, or when any prefix no
+// longer matches, everything is sent with a null state and the clusters are refit
+// from scratch. Returns null when the saved state is already up to date.
+function preferenceRequest(user) {
+  const liked = user.likedPosts || [];
+  const disliked = user.dislikedPosts || [];
+  const favourites = user.favouritePosts || [];
+  const counts = user.clusterStateCounts || {};
+  const lastIds = user.clusterStateLastIds || {};
+  const foldedPrefix = (list, name) => {
+    const count = counts[name] || 0;
+    return count === 0 || (list.length >= count && postId(list[count - 1]) === lastIds[name]);
+  };
+  const incremental = Boolean(user.likedState && user.dislikedState &&
+    foldedPrefix(liked, 'liked') &&
+    foldedPrefix(disliked, 'disliked') &&
+    foldedPrefix(favourites, 'favourite'));
+  const from = incremental ? counts : {};
+  const newLiked = liked.slice(from.liked || 0);
+  const newDisliked = disliked.slice(from.disliked || 0);
+  const newFavourites = favourites.slice(from.favourite || 0);
+  // A side with a saved state but no posts (e.g. no dislikes yet) is up to date too.
+  if (incremental && !newLiked.length && !newDisliked.length && !newFavourites.length) {
+    return null;
   }
-  return recommendedIds;
+  const likedDescriptions = descriptionsOf(newLiked);
+  const favDescriptions = descriptionsOf(newFavourites);
+  return {
+    counts: { liked: liked.length, disliked: disliked.length, favourite: favourites.length },
+    lastIds: { liked: lastId(liked), disliked: lastId(disliked), favourite: lastId(favourites) },
+    request: {
+      userId: user._id.toString(),
+      likedDescriptions: likedDescriptions.concat(favDescriptions),
+      // Weight each favourite 10x instead of sending it 10 times.
+      likedWeights: likedDescriptions.map(() => 1).concat(favDescriptions.map(() => 10)),
+      dislikedDescriptions: descriptionsOf(newDisliked),
+      likedState: incremental ? user.likedState : null,
+      dislikedState: incremental ? user.dislikedState : null
+    }
+  };
+}
+
+// Cluster many users' descriptions in one request; each entry in preferenceUsers is
+// { userId, likedDescriptions, dislikedDescriptions, likedWeights, likedState, dislikedState }.
+async function callCalculatePreferencesBatch(preferenceUsers) {
+  const payload = { users: preferenceUsers };
+  const response = await axios.post(`${PYTHON_SERVICE_URL}/calculate_preferences_batch`, payload, {
+    maxBodyLength: Infinity,
+    maxContentLength: Infinity
+  });
+  return response.data.results;
+}
+
+// Score every user against one shared copy of the catalog in a single request.
+// Each entry in batchUsers is { userId, likedClusters, dislikedClusters, excludeIds }.
+async function callRecommendBatch(batchUsers, posts) {
+  const payload = { users: batchUsers, posts, catalogVersion: catalogVersion(posts) };
+  const response = await axios.post(`${PYTHON_SERVICE_URL}/recommend_batch`, payload, {
+    maxBodyLength: Infinity,
+    maxContentLength: Infinity
+  });
+  return response.data.results;
 }
 
 async function updateUserRecommendations() {
@@ -95,39 +169,84 @@ async function updateUserRecommendations() {
     // Find all users with at least 30 interactions.
     // Now also populate 'favouritePosts' so we can weight them.
     const users = await User.find().populate('likedPosts dislikedPosts favouritePosts');
-    for (const user of users) {
+    const candidates = users.filter(user => {
       const likedCount = user.likedPosts ? user.likedPosts.length : 0;
       const dislikedCount = user.dislikedPosts ? user.dislikedPosts.length : 0;
-      if ((likedCount + dislikedCount) < 30) continue; // Skip users with fewer than 30 interactions.
-      
-      // Ensure clusters exist.
-      if (!user.likedClusters || !user.dislikedClusters || !user.likedClusters.length || !user.dislikedClusters.length) {
-        // Build the combined liked descriptions:
-        const likedDescriptions = user.likedPosts.map(post => post["product_description:"]).filter(Boolean);
-        const favDescriptions = (user.favouritePosts || []).map(post => post["product_description:"]).filter(Boolean);
-        // Duplicate each favourite description 10 times.
-        const weightedFavDescriptions = favDescriptions.flatMap(desc => Array(10).fill(desc));
-        const combinedLikedDescriptions = likedDescriptions.concat(weightedFavDescriptions);
-        
-        const dislikedDescriptions = user.dislikedPosts.map(post => post["product_description:"]).filter(Boolean);
-        const clusters = await callCalculatePreferences(combinedLikedDescriptions, dislikedDescriptions);
-        user.likedClusters = clusters.likedClusters;
-        user.dislikedClusters = clusters.dislikedClusters;
+      return (likedCount + dislikedCount) >= 30; // Skip users with fewer than 30 interactions.
+    });
+
+    // Fold new swipes into the saved cluster state (or fit it) for all such users in one request.
+    const needClusters = [];
+    const pending = [];
+    for (const user of candidates) {
+      const pendingUpdate = preferenceRequest(user);
+      if (pendingUpdate) {
+        needClusters.push(user);
+        pending.push(pendingUpdate);
       }
-      
+    }
+    const failed = new Set();
+    if (needClusters.length) {
+      try {
+        const clusters = await callCalculatePreferencesBatch(pending.map(update => update.request));
+        needClusters.forEach((user, i) => {
+          const result = clusters[i];
+          if (!result || result.error) {
+            console.error(`Error calculating clusters for user ${user._id}:`, result ? result.details || result.error : "no result");
+            // Users with earlier clusters are still recommended from those.
+            if (!hasClusters(user)) failed.add(user);
+            return;
+          }
+          user.likedClusters = result.likedClusters;
+          user.dislikedClusters = result.dislikedClusters;
+          user.likedState = result.likedState;
+          user.dislikedState = result.dislikedState;
+          user.clusterStateCounts = pending[i].counts;
+          user.clusterStateLastIds = pending[i].lastIds;
+        });
+      } catch (error) {
+        console.error("Error calculating clusters:", error);
+        needClusters.filter(user => !hasClusters(user)).forEach(user => failed.add(user));
+      }
+    }
+
+    const eligibleUsers = [];
+    const batchUsers = [];
+    for (const user of candidates) {
+      if (failed.has(user)) continue;
+
       // Exclude posts in liked/disliked and recentBatch.
-      const likedIds = user.likedPosts.map(post => post._id);
-      const dislikedIds = user.dislikedPosts.map(post => post._id);
-      const recentBatch = user.recentBatch || [];
-      const excludedIds = likedIds.concat(dislikedIds, recentBatch);
+      const likedIds = user.likedPosts.map(post => post._id.toString());
+      const dislikedIds = user.dislikedPosts.map(post => post._id.toString());
+      const recentBatch = (user.recentBatch || []).map(id => id.toString());
+      const excludeIds = likedIds.concat(dislikedIds, recentBatch);
       
-      // Sample ALL posts (without a fixed sample size) that are not in excludedIds.
-      const samplePosts = await Post.aggregate([
-        { $match: { _id: { $nin: excludedIds } } },
-        { $project: { _id: 1, "image_url:": 1, "title:": 1, "price:": 1, "product_description:": 1 } }
-      ]);
-      
-      let recommendedIds = await callRecommend(user.likedClusters, user.dislikedClusters, samplePosts);
+      eligibleUsers.push(user);
+      batchUsers.push({
+        userId: user._id.toString(),
+        likedClusters: user.likedClusters,
+        dislikedClusters: user.dislikedClusters,
+        excludeIds
+      });
+    }
+    if (!batchUsers.length) return;
+    
+    // Fetch ALL posts once; each user's exclusions are applied by the Python service.
+    // Sorted so an unchanged catalog always hashes to the same catalogVersion.
+    const catalogPosts = await Post.aggregate([
+      { $sort: { _id: 1 } },
+      { $project: { _id: 1, "image_url:": 1, "title:": 1, "price:": 1, description: 1, embedding: 1 } }
+    ]);
+    
+    const results = await callRecommendBatch(batchUsers, catalogPosts);
+    for (let i = 0; i < eligibleUsers.length; i++) {
+      const user = eligibleUsers[i];
+      const result = results[i];
+      if (!result || result.error) {
+        console.error(`Error updating recommendations for user ${user._id}:`, result ? result.error : "no result");
+        continue;
+      }
+      const recommendedIds = result.recommendations.map(item => item.id);
       // Store only the top 50 recommended posts.
       user.recommendedPosts = recommendedIds.slice(0, 50);
       await user.save();
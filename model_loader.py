@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Loading the SentenceTransformer model, optionally from a local snapshot.
+
+sentence_transformers (and torch) are imported only when a model is actually
+loaded, so CLI runs that fail validation or never encode exit quickly.
+
+By default the model is resolved through the Hugging Face hub cache. Set
+
+    MODEL_SNAPSHOT_DIR   directory of snapshots written by `model_loader.py snapshot`
+    MODEL_QUANTIZED=1    prefer the int8 dynamically quantized copy in that directory
+
+to load it from a plain local directory instead, without any hub lookups.
+Write the snapshot once per deploy (e.g. in the Docker build):
+
+    python3 model_loader.py snapshot /app/model-cache [--quantize]
+"""
+import os
+import sys
+import argparse
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+QUANTIZED_SUFFIX = ".qint8.pt"
+VARIANT_ATTR = "embedding_variant"
+QUANTIZED_VARIANT = "qint8"
+
+def snapshot_path(model_name=DEFAULT_MODEL_NAME, directory=None, quantized=False):
+    directory = directory or os.environ.get("MODEL_SNAPSHOT_DIR")
+    if not directory:
+        return None
+    path = os.path.join(directory, model_name.replace("/", "__"))
+    return path + QUANTIZED_SUFFIX if quantized else path
+
+def model_variant(model):
+    """
+    The variant load_model tagged the model with ("qint8"), or None for a float model.
+    """
+    return getattr(model, VARIANT_ATTR, None)
+
+def load_model(model_name=DEFAULT_MODEL_NAME):
+    """
+    The quantized snapshot if MODEL_QUANTIZED is set and it exists, else the plain
+    snapshot if it exists, else the model resolved by name. The quantized model is
+    tagged with its variant (see model_variant) so its embeddings are cached apart.
+    """
+    if os.environ.get("MODEL_QUANTIZED", "0") != "0":
+        path = snapshot_path(model_name, quantized=True)
+        if path and os.path.exists(path):
+            import torch
+            model = torch.load(path, weights_only=False)
+            setattr(model, VARIANT_ATTR, QUANTIZED_VARIANT)
+            return model
+        sys.stderr.write(f"No quantized snapshot of {model_name}; loading the float model\n")
+    from sentence_transformers import SentenceTransformer
+    path = snapshot_path(model_name)
+    if path and os.path.isdir(path):
+        return SentenceTransformer(path, device="cpu")
+    return SentenceTransformer(model_name)
+
+def save_snapshot(directory, model_name=DEFAULT_MODEL_NAME, quantize=False):
+    """
+    Save the model under directory for load_model, plus an int8 dynamically
+    quantized copy of its Linear layers when quantize is set.
+    """
+    from sentence_transformers import SentenceTransformer
+    os.makedirs(directory, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    path = snapshot_path(model_name, directory)
+    model.save(path)
+    paths = [path]
+    if quantize:
+        import torch
+        quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        quantized_path = snapshot_path(model_name, directory, quantized=True)
+        torch.save(quantized, quantized_path)
+        paths.append(quantized_path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage local SentenceTransformer snapshots")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    snapshot = subparsers.add_parser("snapshot", help="save the model (and optionally an int8 copy) to a directory")
+    snapshot.add_argument("directory")
+    snapshot.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    snapshot.add_argument("--quantize", action="store_true", help="also save an int8 dynamically quantized copy")
+    args = parser.parse_args()
+    for path in save_snapshot(args.directory, args.model, quantize=args.quantize):
+        print(path)
+
+if __name__ == "__main__":
+    main()
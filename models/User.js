@@ -11,6 +11,21 @@ const UserSchema = new mongoose.Schema({
   dislikedPosts: [{ type: mongoose.Schema.Types.ObjectId, ref: 'Post' }],
   likedClusters: { type: Array, default: [] },
   dislikedClusters: { type: Array, default: [] },
+  // Online k-means state per side, returned by /calculate_preferences_batch, and how
+  // many of likedPosts / dislikedPosts / favouritePosts it already includes.
+  likedState: { type: mongoose.Schema.Types.Mixed, default: null },
+  dislikedState: { type: mongoose.Schema.Types.Mixed, default: null },
+  clusterStateCounts: {
+    liked: { type: Number, default: 0 },
+    disliked: { type: Number, default: 0 },
+    favourite: { type: Number, default: 0 }
+  },
+  // Id of the last post of each list folded into the saved state.
+  clusterStateLastIds: {
+    liked: { type: String, default: null },
+    disliked: { type: String, default: null },
+    favourite: { type: String, default: null }
+  },
   recommendedPosts: { type: Array, default: [] },
   recentBatch: { type: Array, default: [] },
   favouritePosts: [{ type: mongoose.Schema.Types.ObjectId, ref: 'Post' }],
@@ -0,0 +1,126 @@
+"""
+Scoring the catalog in parallel shards (and other per-request parallel work).
+
+The catalog matrix is split into contiguous row shards that are scored on a
+shared thread pool. numpy releases the GIL inside matrix products, so shards
+run on separate cores. Each shard keeps only its own best candidates and the
+caller merges them into the global top-N.
+
+Every worker would otherwise start its own BLAS (or OpenMP, e.g. in sklearn's
+KMeans) thread team, so while shards run, those native thread pools are limited
+(with threadpoolctl, when installed) to cpu_count // workers threads. map_parallel
+runs independent tasks, such as per-user clustering, the same way. Configure with:
+
+    SCORING_WORKERS=1    shards scored at once (default 1: score in the calling
+                         thread; 0: one per CPU)
+
+recommendation_server.py takes --workers, which overrides SCORING_WORKERS.
+See `benchmark.py sharding` for throughput versus workers.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # BLAS threads are then left as configured by the environment
+    threadpool_limits = None
+
+WORKERS = int(os.environ.get("SCORING_WORKERS", "1"))
+# Catalogs smaller than this per worker are not worth splitting.
+MIN_SHARD_ROWS = 16384
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+# threadpoolctl limits are process-wide: the first concurrent call applies the
+# limit and the last one to finish restores the original.
+_native_lock = threading.Lock()
+_native_users = 0
+_native_limiter = None
+
+def resolve_workers(workers=None):
+    """
+    The worker count to use: workers if given, else SCORING_WORKERS (or --workers);
+    0 means one per CPU.
+    """
+    workers = WORKERS if workers is None else workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def shard_bounds(num_rows, workers, min_shard_rows=MIN_SHARD_ROWS):
+    """
+    (start, stop) of at most workers contiguous shards covering num_rows rows,
+    none smaller than min_shard_rows unless there is only one.
+    """
+    shards = max(1, min(workers, num_rows // max(1, min_shard_rows)))
+    size = -(-num_rows // shards) if num_rows else 0
+    return [(start, min(start + size, num_rows)) for start in range(0, num_rows, size)] if size else [(0, 0)]
+
+def _get_executor(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers < workers:
+            # A smaller pool may still be in use by another request; it is left to finish.
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scoring")
+            _executor_workers = workers
+        return _executor
+
+@contextmanager
+def native_threads(threads):
+    """
+    Limit BLAS and OpenMP to the given number of threads for the enclosed block.
+    """
+    global _native_users, _native_limiter
+    if threadpool_limits is None:
+        yield
+        return
+    with _native_lock:
+        if _native_users == 0:
+            _native_limiter = threadpool_limits(limits=threads)
+        _native_users += 1
+    try:
+        yield
+    finally:
+        with _native_lock:
+            _native_users -= 1
+            if _native_users == 0:
+                _native_limiter.restore_original_limits()
+                _native_limiter = None
+
+def map_shards(func, num_rows, workers=None, min_shard_rows=MIN_SHARD_ROWS):
+    """
+    func(start, stop) for each shard of num_rows rows, in shard order. With one
+    shard it simply runs in the calling thread.
+    """
+    workers = resolve_workers(workers)
+    bounds = shard_bounds(num_rows, workers, min_shard_rows)
+    if len(bounds) == 1:
+        return [func(*bounds[0])]
+    executor = _get_executor(len(bounds))
+    with native_threads(max(1, (os.cpu_count() or 1) // len(bounds))):
+        futures = [executor.submit(func, start, stop) for start, stop in bounds]
+        return [future.result() for future in futures]
+
+def map_parallel(func, items, workers=None):
+    """
+    [func(item) for item in items], run on up to `workers` threads (default
+    SCORING_WORKERS) of the shared pool.
+    """
+    items = list(items)
+    workers = min(resolve_workers(workers), len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    executor = _get_executor(workers)
+    with native_threads(max(1, (os.cpu_count() or 1) // workers)):
+        # Each thread takes every workers-th item, so only `workers` tasks are submitted.
+        futures = [executor.submit(lambda offset: [func(item) for item in items[offset::workers]], offset)
+                   for offset in range(workers)]
+        parts = [future.result() for future in futures]
+    results = [None] * len(items)
+    for offset, part in enumerate(parts):
+        results[offset::workers] = part
+    return results
@@ -0,0 +1,118 @@
+"""
+Columnar batch of the products sent with a /recommend request.
+
+A request's posts are kept as three columns instead of a DataFrame row (and a
+numpy object) per product:
+
+    ids           object array of the posts' ids
+    descriptions  TextColumn: all descriptions joined into one string, plus offsets
+    embeddings    float32 matrix, one row per product, with a mask of the usable rows
+
+The embedding matrix is what the scorer consumes, and descriptions are only
+sliced out of the joined text for the products that are returned. See
+recommendation.get_product_batch and `benchmark.py products`.
+
+parse_post reads one post for every path that takes posts (requests, streams
+and the embedding store), so they agree on ids, descriptions and which
+embeddings are usable.
+"""
+import sys
+import json
+import numpy as np
+
+from wire_format import decode_vectors, is_blob
+
+def parse_post(post, dim):
+    """
+    (id, description, embedding, usable) of a post as the Node job sends it. id is
+    its '_id' or 'id' as sent. description is always a str: '' when missing or null,
+    else str() of whatever was sent. embedding is
+    a float32 vector of dim values, or None when the post has none (an empty list,
+    the Post model's default, counts as none) or it cannot be decoded, and the
+    description has to be encoded instead. usable is False when an
+    embedding was sent but has the wrong size or non-finite values.
+    Raises ValueError for a post that is not an object.
+    """
+    if not isinstance(post, dict):
+        raise ValueError(f"expected a post object, got {type(post).__name__}")
+    post_id = post.get('_id') or post.get('id')
+    description = post.get('description')
+    description = '' if description is None else str(description)
+    embedding = post.get('embedding', None)
+    if is_blob(embedding):
+        try:
+            embedding = decode_vectors(embedding)
+        except Exception as e:
+            sys.stderr.write(f"Error decoding embedding for post {post_id}: {e}\n")
+            embedding = None
+    elif isinstance(embedding, str):
+        try:
+            embedding = json.loads(embedding)
+        except Exception as e:
+            sys.stderr.write(f"Error converting embedding for post {post_id}: {e}\n")
+            embedding = None
+    if embedding is None or (hasattr(embedding, '__len__') and len(embedding) == 0):
+        return post_id, description, None, True
+    try:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != dim or not np.isfinite(vector).all():
+            raise ValueError(f"expected {dim} finite values")
+    except Exception as e:
+        sys.stderr.write(f"Error reading embedding for post {post_id}: {e}\n")
+        return post_id, description, None, False
+    return post_id, description, vector, True
+
+class TextColumn:
+    """
+    Strings stored as one joined str and an int64 offsets array; text[i] slices
+    string i out on access.
+    """
+    __slots__ = ("text", "offsets")
+
+    def __init__(self, strings):
+        self.text = "".join(strings)
+        self.offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)), out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+class ProductBatch:
+    """
+    ids, descriptions and float32 embeddings of a list of products. valid flags the
+    rows whose embedding can be scored; the others are zero.
+    """
+    __slots__ = ("ids", "descriptions", "embeddings", "valid")
+
+    def __init__(self, ids, descriptions, embeddings, valid=None):
+        self.ids = np.empty(len(ids), dtype=object)
+        self.ids[:] = ids
+        self.descriptions = descriptions if isinstance(descriptions, TextColumn) else TextColumn(descriptions)
+        self.embeddings = embeddings
+        self.valid = valid if valid is not None else np.ones(len(embeddings), dtype=bool)
+        if not len(self.ids) == len(self.descriptions) == len(self.embeddings) == len(self.valid):
+            raise ValueError("product batch columns have different lengths")
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @property
+    def nbytes(self):
+        return (self.ids.nbytes + self.descriptions.offsets.nbytes + self.embeddings.nbytes + self.valid.nbytes
+                + sys.getsizeof(self.descriptions.text))
+
+    def records(self, rows, scores):
+        """
+        [{id, description, final_score}] for the given rows and their scores.
+        """
+        return [
+            {"id": self.ids[row], "description": self.descriptions[row], "final_score": float(score)}
+            for row, score in zip(rows, scores)
+        ]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Compact copies of the catalog embedding matrix for scoring.
+
+Rows are L2-normalized and then stored as
+
+    float16  2 bytes per value
+    int8     1 byte per value plus one float32 scale per row (value = int8 * scale)
+
+instead of 4 bytes per value (float32) in the store, or 8 (float64) in the old
+DataFrame path. Cosine scores are computed directly on the compact rows, which are
+widened to float32 one chunk at a time, so scoring never needs a full-precision copy
+of the catalog. Recommendations can rerank their best candidates against the exact
+float32 rows; see recommendation.recommend_from_store and `benchmark.py quantization`
+for how closely the rankings agree.
+
+The copies are saved next to an EmbeddingStore and extended when products are added:
+
+    python3 quantization.py /var/data/catalog int8
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from embedding_store import normalize_rows
+
+PRECISIONS = ("float32", "float16", "int8")
+SCALES_FILE = "scales.int8.f32"
+CHUNK_ROWS = 65536
+# Rows widened to float32 at a time while scoring; small enough to stay in cache.
+SCORE_CHUNK_ROWS = 4096
+
+def _data_file(precision):
+    return f"normalized.{precision}"
+
+def quantize_rows(matrix, precision):
+    """
+    L2-normalize rows and convert them to the given precision.
+    Returns (data, scales); scales is None except for int8. Zero rows stay zero.
+    """
+    normalized = normalize_rows(matrix)[0]
+    if precision == "int8":
+        scales = np.abs(normalized).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.rint(normalized / scales[:, None]).astype(np.int8)
+        return data, scales.astype(np.float32)
+    return normalized.astype(precision), None
+
+class QuantizedMatrix:
+    """
+    L2-normalized catalog rows in float32, float16 or int8 (with per-row scales).
+    """
+
+    def __init__(self, data, scales=None):
+        self.data = data
+        self.scales = scales
+
+    @property
+    def precision(self):
+        return self.data.dtype.name
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        """
+        The rows in a slice, as a QuantizedMatrix view of the same data.
+        """
+        if not isinstance(index, slice):
+            raise TypeError("QuantizedMatrix only supports slicing")
+        return QuantizedMatrix(self.data[index], self.scales[index] if self.scales is not None else None)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @classmethod
+    def from_matrix(cls, matrix, precision="int8", chunk_rows=CHUNK_ROWS):
+        if precision not in PRECISIONS:
+            raise ValueError(f"unknown precision {precision!r}; expected one of {', '.join(PRECISIONS)}")
+        parts = [quantize_rows(matrix[start:start + chunk_rows], precision)
+                 for start in range(0, len(matrix), chunk_rows)]
+        dim = matrix.shape[1]
+        data = np.concatenate([part[0] for part in parts]) if parts else np.zeros((0, dim), dtype=precision)
+        scales = None
+        if precision == "int8":
+            scales = np.concatenate([part[1] for part in parts]) if parts else np.zeros(0, dtype=np.float32)
+        return cls(data, scales)
+
+    def max_similarity(self, centers, rows=None, chunk_rows=SCORE_CHUNK_ROWS):
+        """
+        Highest cosine similarity between each row (or each of the given rows) and any
+        of the L2-normalized centers (as recommendation.as_centers returns them),
+        computed on the compact rows chunk by chunk.
+        """
+        count = len(self.data) if rows is None else len(rows)
+        if centers is None or len(centers) == 0:
+            return np.zeros(count, dtype=np.float32)
+        centers_t = np.ascontiguousarray(np.asarray(centers, dtype=np.float32).T)
+        result = np.empty(count, dtype=np.float32)
+        for start in range(0, count, chunk_rows):
+            stop = min(start + chunk_rows, count)
+            index = slice(start, stop) if rows is None else rows[start:stop]
+            similarities = (np.asarray(self.data[index], dtype=np.float32) @ centers_t).max(axis=1)
+            if self.scales is not None:
+                similarities *= self.scales[index]
+            result[start:stop] = similarities
+        return result
+
+    def score(self, liked, disliked=None, dislike_weight=1.0, rows=None):
+        """
+        max liked similarity - dislike_weight * max disliked similarity, as
+        recommendation.score_embeddings computes it on the exact rows.
+        """
+        scores = self.max_similarity(liked, rows)
+        if disliked is not None and len(disliked):
+            scores -= dislike_weight * self.max_similarity(disliked, rows)
+        return scores
+
+def load_or_build(store, precision="int8"):
+    """
+    The quantized copy of an EmbeddingStore, saved in its directory. Rows added to
+    the store since the copy was written are quantized and appended.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision {precision!r}; expected one of {', '.join(PRECISIONS)}")
+    matrix = store.matrix
+    num_rows, dim = len(matrix), store.dim
+    itemsize = np.dtype(precision).itemsize
+    data_path = os.path.join(store.directory, _data_file(precision))
+    scales_path = os.path.join(store.directory, SCALES_FILE)
+
+    done = os.path.getsize(data_path) // (dim * itemsize) if os.path.exists(data_path) else 0
+    if precision == "int8":
+        done = min(done, os.path.getsize(scales_path) // 4 if os.path.exists(scales_path) else 0)
+    if done > num_rows:
+        sys.stderr.write(f"Quantized copy {data_path} covers more rows than the store; rebuilding\n")
+        done = 0
+    if done < num_rows:
+        with open(data_path, "ab") as data_file:
+            data_file.truncate(done * dim * itemsize)
+            scales_file = open(scales_path, "ab") if precision == "int8" else None
+            try:
+                if scales_file is not None:
+                    scales_file.truncate(done * 4)
+                for start in range(done, num_rows, CHUNK_ROWS):
+                    data, scales = quantize_rows(matrix[start:min(start + CHUNK_ROWS, num_rows)], precision)
+                    data_file.write(np.ascontiguousarray(data).tobytes())
+                    if scales_file is not None:
+                        scales_file.write(scales.tobytes())
+            finally:
+                if scales_file is not None:
+                    scales_file.close()
+    if num_rows == 0:
+        return QuantizedMatrix.from_matrix(np.zeros((0, dim), dtype=np.float32), precision)
+    data = np.memmap(data_path, dtype=precision, mode="r", shape=(num_rows, dim))
+    scales = np.memmap(scales_path, dtype=np.float32, mode="r", shape=(num_rows,)) if precision == "int8" else None
+    return QuantizedMatrix(data, scales)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the quantized copy of a catalog embedding store")
+    parser.add_argument("store")
+    parser.add_argument("precision", choices=PRECISIONS)
+    args = parser.parse_args()
+    from embedding_store import EmbeddingStore
+    store = EmbeddingStore(args.store)
+    quantized = load_or_build(store, args.precision)
+    print(json.dumps({"rows": len(quantized), "precision": quantized.precision, "bytes": quantized.nbytes}))
+
+if __name__ == "__main__":
+    main()
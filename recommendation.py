@@ -151,92 +151,772 @@ if __name__ == "__main__":
     main()
 '''
 #!/usr/bin/env python3
+import os
 import sys
 import json
-import pandas as pd
+import math
+import heapq
+import argparse
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
 import signal
 
+from embedding_cache import get_embedding_cache
+from model_loader import load_model
+from embedding_store import EmbeddingStore, normalize_rows
+from stream_input import iter_json_request, iter_ndjson_request
+from wire_format import decode_vectors, is_blob
+from instrumentation import PROFILERS, payload_summary, profiled, stage
+from parallel_scoring import map_shards, resolve_workers
+from result_cache import CachedResults, cluster_fingerprint
+from product_batch import ProductBatch, parse_post
+
 # Optionally catch SIGPIPE so that a broken pipe doesn't kill the process silently.
 def handle_sigpipe(signum, frame):
     sys.stderr.write("Received SIGPIPE. Exiting.\n")
     sys.stdout.flush()
     sys.exit(1)
 
-signal.signal(signal.SIGPIPE, handle_sigpipe)
+EMBEDDING_DIM = 384
+INVALID_SCORE = -9999
+# Upper bound on (catalog rows x user centers) similarity entries computed at once by recommend_batch.
+BATCH_CHUNK_ELEMENTS = 32 * 1024 * 1024
+# Posts parsed and scored together by recommend_stream.
+STREAM_CHUNK_SIZE = 4096
+DEFAULT_TOP_N = 30
+MAX_TOP_N = 1000
+# Scores lie in [-1 - dislikeWeight, 1]; the bound keeps every real score above INVALID_SCORE.
+MAX_DISLIKE_WEIGHT = 100.0
+# With diversityLambda < 1, the best top_n * DIVERSITY_POOL_FACTOR products are reranked.
+DIVERSITY_POOL_FACTOR = 4
 
-def get_products_dataframe(posts, model):
+def get_product_batch(posts, model, cache=None, batch_size=None, workers=None, dim=EMBEDDING_DIM, out=None):
     """
-    Convert the list of posts (from JSON) into a DataFrame.
-    If a post does not have an 'embedding', compute it using the model.
+    Parse the list of posts (from JSON) into a ProductBatch. Embeddings are written
+    straight into one float32 matrix (the first rows of out, when given, so a caller
+    can reuse it); posts without an 'embedding' are collected and encoded together,
+    in length-sorted batches through the shared embedding cache. A post whose
+    description cannot be encoded gets a zero vector, and one whose embedding is
+    malformed is flagged invalid (see product_batch.parse_post).
     """
-    data = []
+    if cache is None:
+        cache = get_embedding_cache()
+    ids, descriptions, pending = [], [], []
+    if out is None:
+        matrix = np.zeros((len(posts), dim), dtype=np.float32)
+    else:
+        matrix = out[:len(posts)]
+        matrix[:] = 0.0
+    valid = np.ones(len(posts), dtype=bool)
     for post in posts:
         try:
-            # Get an identifier (either _id or id)
-            post_id = post.get('_id') or post.get('id')
-            description = post.get('description', '')
-            embedding = post.get('embedding', None)
-            if embedding is None:
-                embedding = model.encode(description).tolist()
-            else:
-                if isinstance(embedding, str):
-                    try:
-                        embedding = eval(embedding)
-                    except Exception as e:
-                        sys.stderr.write(f"Error converting embedding for post {post_id}: {e}\n")
-                        embedding = model.encode(description).tolist()
-            data.append({
-                "id": post_id,
-                "description": description,
-                "embedding": np.array(embedding)
-            })
-        except Exception as e:
+            post_id, description, vector, usable = parse_post(post, dim)
+        except ValueError as e:
             sys.stderr.write(f"Error processing post {post}: {e}\n")
             continue
+        row = len(ids)
+        ids.append(post_id)
+        descriptions.append(description)
+        if not usable:
+            valid[row] = False
+        elif vector is None:
+            pending.append(row)
+        else:
+            matrix[row] = vector
+    if len(ids) < len(posts):
+        matrix, valid = matrix[:len(ids)], valid[:len(ids)]
+    if pending:
+        matrix[pending] = cache.encode(
+            model,
+            [descriptions[i] for i in pending],
+            batch_size=batch_size,
+            workers=workers,
+            fallback=np.zeros(dim, dtype=np.float32)
+        )
+    return ProductBatch(ids, descriptions, matrix, valid)
+
+def max_similarity(normalized_products, centers):
+    """
+    Highest cosine similarity between each product and any of the given centers.
+    Both must already be L2-normalized, so this is a single matrix product.
+    """
+    if centers is None or len(centers) == 0:
+        return np.zeros(normalized_products.shape[0], dtype=np.float32)
+    return (normalized_products @ centers.T).max(axis=1)
+
+def score_normalized(normalized, liked, disliked=None, dislike_weight=1.0):
+    """
+    Score L2-normalized rows against centers from as_centers as
+    max liked similarity - dislike_weight * max disliked similarity.
+    """
+    scores = max_similarity(normalized, liked)
+    if disliked is not None and len(disliked):
+        scores -= dislike_weight * max_similarity(normalized, disliked)
+    return scores
+
+def score_embeddings(matrix, user_liked_centers, user_disliked_centers=None, dislike_weight=1.0):
+    """
+    Score raw embedding rows against centers from as_centers. The rows are normalized
+    here; zero rows carry no direction to compare and score INVALID_SCORE.
+    """
+    normalized, nonzero = normalize_rows(matrix)
+    scores = score_normalized(normalized, user_liked_centers, user_disliked_centers, dislike_weight)
+    scores[~nonzero] = INVALID_SCORE
+    return scores
+
+def select_top_n(scores, top_n):
+    """
+    Indices of the top_n highest scores, best first, without sorting the whole array.
+    """
+    if top_n <= 0:
+        return np.empty(0, dtype=np.intp)
+    if top_n < len(scores):
+        candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def request_options(data):
+    """
+    top_n, dislike_weight and diversity_lambda from a request's optional topN,
+    dislikeWeight and diversityLambda. The defaults (30, 1.0, 1.0) give the plain
+    relevance ranking. Raises ValueError for out-of-range values.
+    """
+    def number(name, default, low, high=math.inf):
+        value = data.get(name, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+            bounds = f"between {low} and {high}" if high != math.inf else f"at least {low}"
+            raise ValueError(f"{name} must be a number {bounds}")
+        return value
+
+    top_n = number("topN", DEFAULT_TOP_N, 1, MAX_TOP_N)
+    if top_n != int(top_n):
+        raise ValueError("topN must be an integer")
+    return {
+        "top_n": int(top_n),
+        "dislike_weight": float(number("dislikeWeight", 1.0, 0.0, MAX_DISLIKE_WEIGHT)),
+        "diversity_lambda": float(number("diversityLambda", 1.0, 0.0, 1.0)),
+    }
+
+def pool_size(top_n, diversity_lambda):
+    """
+    Number of best products to fetch before reranking for diversity.
+    """
+    return top_n * DIVERSITY_POOL_FACTOR if diversity_lambda < 1.0 else top_n
+
+def mmr_rerank(vectors, relevance, top_n, diversity_lambda):
+    """
+    Order of up to top_n of the candidates by maximal marginal relevance. Each pick
+    maximizes
+        diversity_lambda * relevance - (1 - diversity_lambda) * max similarity to the picks so far
+    so near-duplicates of an already picked product drop back. vectors are the
+    candidates' L2-normalized embeddings and relevance their scores, best first;
+    diversity_lambda 1.0 keeps that order. Candidates scoring INVALID_SCORE or less
+    are only used after all the others.
+    """
+    count = min(top_n, len(relevance))
+    if diversity_lambda >= 1.0 or count == 0:
+        return np.arange(count)
+    scoreable = np.flatnonzero(relevance > INVALID_SCORE)
+    rest = np.flatnonzero(relevance <= INVALID_SCORE)
+    if len(scoreable) == 0:
+        return rest[:count]
+    candidates = np.asarray(vectors, dtype=np.float32)[scoreable]
+    similarity = candidates @ candidates.T
+    gain = diversity_lambda * np.asarray(relevance, dtype=np.float32)[scoreable]
+    penalty = 1.0 - diversity_lambda
+    picks = [int(np.argmax(gain))]
+    redundancy = similarity[picks[0]].copy()
+    available = np.ones(len(scoreable), dtype=bool)
+    available[picks[0]] = False
+    for _ in range(min(count, len(scoreable)) - 1):
+        marginal = np.where(available, gain - penalty * redundancy, -np.inf)
+        pick = int(np.argmax(marginal))
+        picks.append(pick)
+        available[pick] = False
+        np.maximum(redundancy, similarity[pick], out=redundancy)
+    return np.concatenate([scoreable[picks], rest])[:count]
+
+def as_centers(centers, dim=None):
+    """
+    Convert cluster centers (a nested list or a wire_format blob) to a 2-D float32 array
+    of L2-normalized centers, or None when there are none. This is the one place user
+    centers are normalized. Zero-norm centers are dropped: they would make every
+    similarity at least 0 instead of contributing a direction.
+    """
+    if is_blob(centers):
+        centers = decode_vectors(centers)
+    if centers is None or len(centers) == 0:
+        return None
+    centers = np.asarray(centers, dtype=np.float32)
+    if centers.ndim == 1:
+        centers = centers.reshape(1, -1)
+    if centers.ndim != 2 or (dim is not None and centers.shape[1] != dim):
+        raise ValueError(f"cluster centers have shape {centers.shape}")
+    if not np.isfinite(centers).all():
+        raise ValueError("cluster centers contain non-finite values")
+    normalized, nonzero = normalize_rows(centers)
+    if not nonzero.all():
+        sys.stderr.write(f"Ignoring {int((~nonzero).sum())} zero-norm cluster centers\n")
+        normalized = normalized[nonzero]
+    return normalized if len(normalized) else None
+
+def recommend_products(user_liked_centers, user_disliked_centers, products, top_n=30, dislike_weight=1.0,
+                       diversity_lambda=1.0):
+    """
+    Compute a recommendation score for each product of a ProductBatch and return the
+    top_n as [{id, description, final_score}]; only their descriptions are sliced out.
+    All products are scored at once: the batch's float32 embedding matrix is compared
+    with the user centers in a pair of matrix products, split into row shards across
+    SCORING_WORKERS threads (see parallel_scoring). Products whose embedding cannot be
+    scored get -9999. With diversity_lambda < 1 the best candidates are reranked with
+    mmr_rerank.
+    """
+    scores = np.full(len(products), INVALID_SCORE, dtype=np.float64)
     try:
-        df = pd.DataFrame(data)
-        return df
+        liked = as_centers(user_liked_centers)
+        disliked = as_centers(user_disliked_centers, dim=liked.shape[1]) if liked is not None else None
     except Exception as e:
-        sys.stderr.write(f"Error creating DataFrame: {e}\n")
-        raise
+        sys.stderr.write(f"Error preparing cluster centers: {e}\n")
+        liked = None
+    if liked is not None and len(products) and products.dim != liked.shape[1]:
+        sys.stderr.write(f"Product embeddings have {products.dim} values, cluster centers {liked.shape[1]}\n")
+        liked = None
+    if liked is not None and len(products):
+        valid = products.valid
+        # Only copied when some rows have to be left out.
+        matrix = products.embeddings if valid.all() else products.embeddings[valid]
+        scores[valid] = np.concatenate(map_shards(
+            lambda start, stop: score_embeddings(matrix[start:stop], liked, disliked, dislike_weight),
+            len(matrix)
+        ))
+    top = select_top_n(scores, pool_size(top_n, diversity_lambda))
+    if liked is not None and diversity_lambda < 1.0:
+        # Rows with an unusable embedding are zero and stay zero.
+        top = top[mmr_rerank(normalize_rows(products.embeddings[top])[0], scores[top], top_n, diversity_lambda)]
+    top = top[:top_n]
+    return products.records(top, scores[top])
 
-def recommend_products(user_liked_centers, user_disliked_centers, products_df, top_n=30, dislike_weight=1.0):
+def _score_store_rows(matrix, rows, liked, disliked, dislike_weight, quantized=None):
     """
-    Compute a recommendation score for each product and return the top_n recommendations.
+    Scores of the given catalog rows (all rows when None), computed on the quantized
+    copy where it covers them and on the exact float32 rows otherwise.
     """
-    product_scores = []
-    for idx, row in products_df.iterrows():
+    if quantized is None:
+        return score_normalized(matrix if rows is None else matrix[rows], liked, disliked, dislike_weight)
+    if rows is None:
+        if len(quantized) >= len(matrix):
+            return quantized.score(liked, disliked, dislike_weight)
+        rows = np.arange(len(matrix))
+    covered = rows < len(quantized)
+    scores = np.empty(len(rows), dtype=np.float32)
+    scores[covered] = quantized.score(liked, disliked, dislike_weight, rows[covered])
+    if not covered.all():
+        # Products added after the quantized copy was last extended.
+        scores[~covered] = score_normalized(matrix[rows[~covered]], liked, disliked, dislike_weight)
+    return scores
+
+def _store_shard_candidates(matrix, rows, start, stop, liked, disliked, dislike_weight, quantized,
+                            zero_rows, excluded, k):
+    """
+    The best k (rows, scores) among positions start:stop of rows, or of the whole
+    catalog when rows is None. Zero rows score INVALID_SCORE; excluded rows are dropped.
+    """
+    if rows is None:
+        shard_rows = np.arange(start, stop)
+        shard_quantized = quantized[start:stop] if quantized is not None else None
+        scores = _score_store_rows(matrix[start:stop], None, liked, disliked, dislike_weight, shard_quantized)
+    else:
+        shard_rows = rows[start:stop]
+        scores = _score_store_rows(matrix, shard_rows, liked, disliked, dislike_weight, quantized)
+    if len(zero_rows):
+        scores[np.isin(shard_rows, zero_rows)] = INVALID_SCORE
+    if len(excluded):
+        scores[np.isin(shard_rows, excluded)] = -np.inf
+    top = select_top_n(scores, k)
+    top = top[np.isfinite(scores[top])]
+    return shard_rows[top], scores[top]
+
+def recommend_from_store(store, user_liked_centers, user_disliked_centers, post_ids=None, exclude_ids=None,
+                         top_n=30, dislike_weight=1.0, ann_index=None, n_probe=8, quantized=None, rerank=0,
+                         workers=None, diversity_lambda=1.0):
+    """
+    Score products straight from a precomputed EmbeddingStore and return the top_n as
+    [{id, description, final_score}]. When post_ids is given only those products are
+    scored, otherwise the whole catalog except exclude_ids. With an ann_index, only
+    the candidates near the liked centers are scored exactly; if that leaves fewer
+    than top_n products the whole catalog is scanned instead.
+    With a quantization.QuantizedMatrix the scores are computed on the compact rows;
+    rerank > 0 then re-scores the best max(rerank, top_n) of them on the exact rows.
+    The store keeps its rows L2-normalized, so scoring is a pure matrix product;
+    its zero rows score INVALID_SCORE. The rows are scored in shards on `workers`
+    threads (default SCORING_WORKERS), each keeping only its own best candidates.
+    With diversity_lambda < 1 the best candidates are reranked with mmr_rerank.
+    """
+    liked = as_centers(user_liked_centers, dim=store.dim)
+    if liked is None:
+        raise ValueError("likedClusters are required")
+    disliked = as_centers(user_disliked_centers, dim=store.dim)
+    # Take one reference so a concurrent add_posts cannot change the matrix under us.
+    matrix = store.matrix
+    if post_ids is not None:
+        rows = store.rows(post_ids)
+        rows = rows[rows < len(matrix)]
+    elif ann_index is not None:
+        rows = ann_index.candidates(liked, n_probe=n_probe, total_rows=len(matrix))
+    else:
+        rows = None
+    excluded = store.rows(exclude_ids) if exclude_ids else np.empty(0, dtype=np.intp)
+    zero_rows = store.zero_rows
+
+    reranking = quantized is not None and rerank > 0
+    pool = pool_size(top_n, diversity_lambda)
+    k = max(rerank, pool) if reranking else pool
+
+    while True:
+        shards = map_shards(
+            lambda start, stop: _store_shard_candidates(matrix, rows, start, stop, liked, disliked, dislike_weight,
+                                                        quantized, zero_rows, excluded, k),
+            len(matrix) if rows is None else len(rows),
+            workers
+        )
+        candidates = np.concatenate([shard_rows for shard_rows, _ in shards])
+        scores = np.concatenate([shard_scores for _, shard_scores in shards])
+        if reranking:
+            # Keep the best k of all shards, then re-score them on the exact rows.
+            best = select_top_n(scores, k)
+            candidates = candidates[best]
+            scores = score_normalized(matrix[candidates], liked, disliked, dislike_weight)
+            if len(zero_rows):
+                scores[np.isin(candidates, zero_rows)] = INVALID_SCORE
+        top = select_top_n(scores, pool)
+        if len(top) >= top_n or post_ids is not None or rows is None or len(rows) == len(matrix):
+            break
+        # Too few approximate candidates survived the exclusions: fall back to the exact scan.
+        rows = None
+    if diversity_lambda < 1.0:
+        top = top[mmr_rerank(matrix[candidates[top]], scores[top], top_n, diversity_lambda)]
+    top = top[:top_n]
+    return [
+        {"id": store.ids[row], "description": store.descriptions[row], "final_score": float(score)}
+        for row, score in zip(candidates[top], scores[top])
+    ]
+
+def recommend_from_store_cached(cache, store, user_liked_centers, user_disliked_centers, exclude_ids=None,
+                                top_n=30, dislike_weight=1.0, fingerprint=None, **options):
+    """
+    recommend_from_store for a whole-catalog request, answered from a
+    result_cache.ResultCache when the user's centers (or the given fingerprint) were
+    seen before: as is, by filtering out new exclude_ids, or by scoring only the
+    products added to the store since. The options (ann_index, n_probe, quantized,
+    rerank, workers) are passed on; those that change the results are part of the key.
+    Diversified requests (diversity_lambda < 1) are not cached: their lists cannot be
+    filtered or extended.
+    """
+    if options.get("diversity_lambda", 1.0) < 1.0:
+        return recommend_from_store(store, user_liked_centers, user_disliked_centers, exclude_ids=exclude_ids,
+                                    top_n=top_n, dislike_weight=dislike_weight, **options)
+    liked = as_centers(user_liked_centers, dim=store.dim)
+    if liked is None:
+        raise ValueError("likedClusters are required")
+    disliked = as_centers(user_disliked_centers, dim=store.dim)
+    variant = (
+        options.get("n_probe", 8) if options.get("ann_index") is not None else None,
+        options["quantized"].precision if options.get("quantized") is not None else None,
+        options.get("rerank", 0) if options.get("quantized") is not None else None,
+    )
+    key = (fingerprint or cluster_fingerprint(liked, disliked), store.directory, top_n, dislike_weight, variant)
+    version = len(store.matrix)
+    excluded = frozenset(str(post_id) for post_id in exclude_ids or ())
+    count = top_n + cache.overfetch
+
+    entry = cache.get(key, version, append_only=True)
+    outcome = None
+    if entry is not None and entry.version != version:
+        added = recommend_from_store(store, liked, disliked, post_ids=store.ids[entry.version:version],
+                                     exclude_ids=entry.excluded, top_n=count, dislike_weight=dislike_weight,
+                                     **options)
+        entry = entry.extended(version, added)
+        cache.put(key, entry)
+        outcome = "incremental"
+    answer = entry.answer(excluded, top_n) if entry is not None else None
+    if answer is not None:
+        cache.record(outcome or ("hits" if excluded == entry.excluded else "filtered"))
+        return answer
+
+    recommendations = recommend_from_store(store, liked, disliked, exclude_ids=excluded, top_n=count,
+                                           dislike_weight=dislike_weight, **options)
+    cache.put(key, CachedResults(version, excluded, recommendations, count))
+    cache.record("misses")
+    return recommendations[:top_n]
+
+def _stack_centers(center_lists):
+    """
+    Stack several users' (already normalized) centers into one matrix.
+    Returns the matrix and the row where each user's centers start.
+    """
+    starts = np.cumsum([0] + [len(centers) for centers in center_lists[:-1]])
+    return np.concatenate(center_lists), starts
+
+def _merge_best(best_scores, best_rows, scores, rows, k):
+    """
+    Every user's k best of two (candidates x users) score/row blocks, in one vectorized step.
+    """
+    candidate_scores = np.concatenate([best_scores, scores])
+    candidate_rows = np.concatenate([best_rows, rows])
+    if len(candidate_scores) <= k:
+        return candidate_scores, candidate_rows
+    keep = np.argpartition(-candidate_scores, k - 1, axis=0)[:k]
+    return np.take_along_axis(candidate_scores, keep, axis=0), np.take_along_axis(candidate_rows, keep, axis=0)
+
+def recommend_batch(matrix, users, top_n=30, dislike_weight=1.0, valid=None, chunk_elements=BATCH_CHUNK_ELEMENTS,
+                    workers=None):
+    """
+    Score one shared catalog matrix of L2-normalized rows (an EmbeddingStore matrix, or
+    the output of normalize_rows) for many users at once.
+    Each user is a dict with "liked" and "disliked" centers (as returned by as_centers)
+    and optional "excluded" catalog rows. All users' centers are stacked, so each chunk
+    of catalog rows costs one matrix product for the liked centers and one for the
+    disliked centers, whatever the number of users. The catalog is split into row
+    shards scored on `workers` threads (default SCORING_WORKERS); chunks are sized so
+    the (rows x centers) similarity blocks of all shards together stay under chunk_elements.
+    Returns one (rows, scores) pair per user, best first.
+    """
+    if not users:
+        return []
+    liked_all, liked_starts = _stack_centers([user["liked"] for user in users])
+    with_disliked = [i for i, user in enumerate(users) if user.get("disliked") is not None]
+    disliked_all = disliked_starts = None
+    if with_disliked:
+        disliked_all, disliked_starts = _stack_centers([users[i]["disliked"] for i in with_disliked])
+    exclusions = [
+        (i, np.sort(np.asarray(user["excluded"], dtype=np.intp)))
+        for i, user in enumerate(users) if user.get("excluded") is not None and len(user["excluded"])
+    ]
+
+    num_rows = len(matrix)
+    k = min(top_n, num_rows)
+    total_centers = len(liked_all) + (len(disliked_all) if disliked_all is not None else 0)
+    workers = resolve_workers(workers)
+    rows_per_chunk = max(1, chunk_elements // (total_centers * workers))
+    empty_scores = np.empty((0, len(users)), dtype=np.float32)
+    empty_rows = np.empty((0, len(users)), dtype=np.intp)
+
+    def best_in_shard(shard_start, shard_stop):
+        best_scores, best_rows = empty_scores, empty_rows
+        for start in range(shard_start, shard_stop, rows_per_chunk):
+            stop = min(start + rows_per_chunk, shard_stop)
+            chunk = np.asarray(matrix[start:stop], dtype=np.float32)
+            scores = np.maximum.reduceat(chunk @ liked_all.T, liked_starts, axis=1)
+            if disliked_all is not None:
+                disliked_max = np.maximum.reduceat(chunk @ disliked_all.T, disliked_starts, axis=1)
+                scores[:, with_disliked] -= dislike_weight * disliked_max
+            if valid is not None:
+                scores[~valid[start:stop]] = INVALID_SCORE
+            for i, excluded in exclusions:
+                lo, hi = np.searchsorted(excluded, [start, stop])
+                scores[excluded[lo:hi] - start, i] = -np.inf
+            # Merge this chunk into every user's running top-k.
+            rows = np.broadcast_to(np.arange(start, stop, dtype=np.intp)[:, None], scores.shape)
+            best_scores, best_rows = _merge_best(best_scores, best_rows, scores, rows, k)
+        return best_scores, best_rows
+
+    best_scores, best_rows = empty_scores, empty_rows
+    for shard_scores, shard_rows in map_shards(best_in_shard, num_rows, workers):
+        best_scores, best_rows = _merge_best(best_scores, best_rows, shard_scores, shard_rows, k)
+
+    results = []
+    for i in range(len(users)):
+        order = np.argsort(-best_scores[:, i], kind="stable")
+        order = order[np.isfinite(best_scores[order, i])]
+        results.append((best_rows[order, i], best_scores[order, i]))
+    return results
+
+def _batch_catalog(posts, model, store, matrix=None):
+    """
+    The shared catalog of a batch request as (normalized matrix, valid mask or None,
+    ids, descriptions, rows_for), where rows_for maps post ids to matrix rows.
+    """
+    if posts:
+        products = get_product_batch(posts, model)
+        ids, descriptions = products.ids, products.descriptions
+        matrix, nonzero = normalize_rows(products.embeddings)
+        valid = products.valid & nonzero
+        id_array = np.array([str(post_id) for post_id in ids], dtype=object)
+        rows_for = lambda post_ids: np.flatnonzero(np.isin(id_array, [str(post_id) for post_id in post_ids]))
+        return matrix, valid, ids, descriptions, rows_for
+    matrix = store.matrix if matrix is None else matrix
+    valid = None
+    if len(store.zero_rows):
+        valid = np.ones(len(matrix), dtype=bool)
+        valid[store.zero_rows[store.zero_rows < len(matrix)]] = False
+    return matrix, valid, store.ids, store.descriptions, store.rows
+
+def recommend_batch_request(data, model=None, store=None, top_n=30, dislike_weight=1.0, workers=None, cache=None,
+                            diversity_lambda=1.0):
+    """
+    Recommend for every user in {"users": [{userId, likedClusters, dislikedClusters,
+    excludeIds}], "posts": [...]} against one shared catalog: the posts when given,
+    otherwise the embedding store. Returns [{userId, recommendations}] in request
+    order; a user whose clusters are unusable gets {userId, error} instead.
+    With a result_cache.ResultCache, users are answered from their cached lists where
+    possible: store requests are versioned by the store's row count, posts requests
+    only when they carry a "catalogVersion". Users may send a "clusterFingerprint"
+    instead of having it derived from their centers. The posts are only parsed and
+    encoded when some user has to be scored. With diversity_lambda < 1 each user's
+    best candidates are reranked with mmr_rerank, and the cache is not used.
+    """
+    users = data.get("users") or []
+    posts = data.get("posts")
+    if not posts and store is None:
+        raise ValueError("posts are required when no catalog store is configured")
+    if posts:
+        dim, catalog, version, matrix = EMBEDDING_DIM, "posts", data.get("catalogVersion"), None
+    else:
+        # Take one reference so a concurrent add_posts cannot change the matrix under us.
+        matrix = store.matrix
+        dim, catalog, version = store.dim, store.directory, len(matrix)
+    if cache is not None and (version is None or not cache.enabled or diversity_lambda < 1.0):
+        cache = None
+    count = top_n + cache.overfetch if cache is not None else pool_size(top_n, diversity_lambda)
+
+    results = [None] * len(users)
+    misses, extensions = [], {}
+    for i, user in enumerate(users):
+        user_id = user.get("userId")
         try:
-            product_embedding = row["embedding"].reshape(1, -1)
-            liked_similarities = cosine_similarity(product_embedding, user_liked_centers)
-            liked_score = liked_similarities.max()
-            disliked_score = 0
-            if user_disliked_centers is not None and len(user_disliked_centers) > 0:
-                disliked_similarities = cosine_similarity(product_embedding, user_disliked_centers)
-                disliked_score = disliked_similarities.max()
-            final_score = liked_score - dislike_weight * disliked_score
-            product_scores.append(final_score)
+            liked = as_centers(user.get("likedClusters"), dim=dim)
+            if liked is None:
+                raise ValueError("likedClusters are required")
+            disliked = as_centers(user.get("dislikedClusters"), dim=dim)
         except Exception as e:
-            sys.stderr.write(f"Error scoring product at index {idx}: {e}\n")
-            product_scores.append(-9999)
-    products_df["final_score"] = product_scores
-    recommended = products_df.sort_values("final_score", ascending=False)
-    return recommended.head(top_n)
+            results[i] = {"userId": user_id, "error": "Error processing clusters", "details": str(e)}
+            continue
+        prepared = {
+            "position": i,
+            "liked": liked,
+            "disliked": disliked,
+            "exclude_ids": frozenset(str(post_id) for post_id in user.get("excludeIds") or ()),
+        }
+        if cache is not None:
+            fingerprint = user.get("clusterFingerprint") or cluster_fingerprint(liked, disliked)
+            prepared["key"] = (fingerprint, catalog, top_n, dislike_weight)
+            entry = cache.get(prepared["key"], version, append_only=not posts)
+            if entry is not None and entry.version != version:
+                prepared["entry"] = entry
+                extensions.setdefault(entry.version, []).append(prepared)
+                continue
+            answer = entry.answer(prepared["exclude_ids"], top_n) if entry is not None else None
+            if answer is not None:
+                cache.record("hits" if prepared["exclude_ids"] == entry.excluded else "filtered")
+                results[i] = {"userId": user_id, "recommendations": answer}
+                continue
+        misses.append(prepared)
+    if not misses and not extensions:
+        return results
+
+    matrix, valid, ids, descriptions, rows_for = _batch_catalog(posts, model, store, matrix)
+    to_results = lambda rows, scores: [
+        {"id": ids[row], "description": descriptions[row], "final_score": float(score)}
+        for row, score in zip(rows, scores)
+    ]
+
+    # Cached lists of a smaller store only need the rows added since.
+    for start, group in extensions.items():
+        block = []
+        for user in group:
+            # The entry's own exclusions, so the merged list stays consistent with them.
+            excluded = rows_for(user["entry"].excluded) if user["entry"].excluded else np.empty(0, dtype=np.intp)
+            block.append({"liked": user["liked"], "disliked": user["disliked"], "excluded": excluded[excluded >= start] - start})
+        block_valid = valid[start:] if valid is not None else None
+        ranked = recommend_batch(matrix[start:], block, count, dislike_weight, block_valid, workers=workers)
+        for user, (rows, scores) in zip(group, ranked):
+            entry = user["entry"].extended(version, to_results(rows + start, scores))
+            cache.put(user["key"], entry)
+            answer = entry.answer(user["exclude_ids"], top_n)
+            if answer is None:
+                misses.append(user)
+                continue
+            cache.record("incremental")
+            results[user["position"]] = {"userId": users[user["position"]].get("userId"), "recommendations": answer}
+
+    ranked = recommend_batch(matrix, [{
+        "liked": user["liked"],
+        "disliked": user["disliked"],
+        "excluded": rows_for(user["exclude_ids"]) if user["exclude_ids"] else None,
+    } for user in misses], count, dislike_weight, valid, workers=workers)
+    for user, (rows, scores) in zip(misses, ranked):
+        if diversity_lambda < 1.0:
+            order = mmr_rerank(np.asarray(matrix[rows], dtype=np.float32), scores, top_n, diversity_lambda)
+            rows, scores = rows[order], scores[order]
+        recommendations = to_results(rows, scores)
+        if cache is not None:
+            cache.put(user["key"], CachedResults(version, user["exclude_ids"], recommendations, count))
+            cache.record("misses")
+        results[user["position"]] = {
+            "userId": users[user["position"]].get("userId"),
+            "recommendations": recommendations[:top_n],
+        }
+    return results
+
+def recommend_stream(events, model, top_n=None, dislike_weight=None, chunk_size=STREAM_CHUNK_SIZE, cache=None,
+                     diversity_lambda=None):
+    """
+    Score posts as they arrive from a stream_input reader and return the top_n as
+    [{id, description, final_score}]. Each chunk of posts is parsed straight into one
+    reused float32 matrix and scored, and only a running top-N heap is kept, so memory
+    stays bounded by chunk_size whatever the catalog size. Posts that arrive before
+    likedClusters are buffered until it has been read.
+    top_n, dislike_weight and diversity_lambda default to the request's topN,
+    dislikeWeight and diversityLambda (see request_options), which must then come
+    before the posts. With diversity_lambda < 1 the heap keeps a larger pool with
+    its embeddings, reranked with mmr_rerank at the end.
+    """
+    if cache is None:
+        cache = get_embedding_cache()
+    fields = {}
+    centers = {}
+    heap = []
+    pending = []
+    seen = 0
+
+    def score_chunk(posts):
+        nonlocal seen
+        if not centers:
+            options = request_options(fields)
+            for name, value in (("top_n", top_n), ("dislike_weight", dislike_weight),
+                                ("diversity_lambda", diversity_lambda)):
+                if value is not None:
+                    options[name] = value
+            centers["options"] = options
+            centers["pool"] = pool_size(options["top_n"], options["diversity_lambda"])
+            centers["liked"] = as_centers(fields.get("likedClusters"))
+            if centers["liked"] is None:
+                raise ValueError("Missing required data: likedClusters and posts are required.")
+            centers["disliked"] = as_centers(fields.get("dislikedClusters"), dim=centers["liked"].shape[1])
+            centers["matrix"] = np.zeros((chunk_size, centers["liked"].shape[1]), dtype=np.float32)
+        products = get_product_batch(posts, model, cache, dim=centers["matrix"].shape[1], out=centers["matrix"])
+        matrix, valid = products.embeddings, products.valid
+        options, pool = centers["options"], centers["pool"]
+        diversify = options["diversity_lambda"] < 1.0
+        scores = np.full(len(products), INVALID_SCORE, dtype=np.float64)
+        scores[valid] = score_embeddings(matrix[valid], centers["liked"], centers["disliked"],
+                                         options["dislike_weight"])
+        for i in select_top_n(scores, pool):
+            # Earlier posts win ties, as in a stable sort of the whole catalog.
+            entry = (float(scores[i]), -(seen + i), products.ids[i], products.descriptions[i],
+                     matrix[i].copy() if diversify and valid[i] else None)
+            if len(heap) < pool:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        seen += len(products)
+
+    for event in events:
+        if event[0] == "field":
+            fields[event[1]] = event[2]
+            continue
+        pending.append(event[1])
+        if len(pending) >= chunk_size and "likedClusters" in fields:
+            score_chunk(pending)
+            pending = []
+    if not fields.get("likedClusters") or not (seen or pending):
+        raise ValueError("Missing required data: likedClusters and posts are required.")
+    for start in range(0, len(pending), chunk_size):
+        score_chunk(pending[start:start + chunk_size])
+    ranked = sorted(heap, reverse=True)
+    options = centers["options"]
+    if options["diversity_lambda"] < 1.0 and ranked:
+        dim = centers["matrix"].shape[1]
+        vectors = np.stack([entry[4] if entry[4] is not None else np.zeros(dim, dtype=np.float32) for entry in ranked])
+        order = mmr_rerank(normalize_rows(vectors)[0], np.array([entry[0] for entry in ranked]),
+                           options["top_n"], options["diversity_lambda"])
+        ranked = [ranked[i] for i in order]
+    return [
+        {"id": post_id, "description": description, "final_score": score}
+        for score, _, post_id, description, _ in ranked[:options["top_n"]]
+    ]
+
+def main_stream(ndjson=False):
+    """
+    CLI handling of a streamed request read incrementally from stdin.
+    """
+    try:
+        sys.stderr.write("Initializing SentenceTransformer model...\n")
+        with stage("load_model"):
+            model = load_model()
+        events = iter_ndjson_request(sys.stdin.buffer) if ndjson else iter_json_request(sys.stdin.buffer)
+        with stage("recommend_stream"):
+            recommendations_list = recommend_stream(events, model)
+    except Exception as e:
+        sys.stderr.write(f"Error computing streamed recommendations: {e}\n")
+        print(json.dumps({"error": "Error computing recommendations", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    with stage("serialize", rows=len(recommendations_list)):
+        print(json.dumps(recommendations_list))
+    sys.stdout.flush()
+
+def main_batch(data):
+    """
+    CLI handling of a multi-user request; see recommend_batch_request.
+    """
+    posts = data.get("posts")
+    store_dir = os.environ.get("CATALOG_STORE_DIR")
+    try:
+        options = request_options(data)
+    except ValueError as e:
+        sys.stderr.write(f"Invalid request parameters: {e}\n")
+        print(json.dumps({"error": "Invalid request parameters", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    try:
+        model = None
+        store = None
+        if posts:
+            sys.stderr.write("Initializing SentenceTransformer model...\n")
+            with stage("load_model"):
+                model = load_model()
+        elif store_dir:
+            store = EmbeddingStore(store_dir)
+        with stage("recommend_batch", users=len(data.get("users") or [])) as record:
+            results = recommend_batch_request(data, model=model, store=store, **options)
+            record["rows"] = len(posts) if posts else (len(store) if store is not None else 0)
+    except Exception as e:
+        sys.stderr.write(f"Error computing batch recommendations: {e}\n")
+        print(json.dumps({"error": "Error computing recommendations", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
+    with stage("serialize", rows=len(results)):
+        print(json.dumps({"results": results}))
+    sys.stdout.flush()
 
 def main():
+    parser = argparse.ArgumentParser(description="Recommend products for one user (JSON on stdin)")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse the JSON request incrementally (needs ijson) and score posts in chunks")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="read NDJSON: the request without posts, then one post per line")
+    parser.add_argument("--profile", choices=PROFILERS, default=None,
+                        help="profile the request with cProfile or tracemalloc (default: PROFILE env var)")
+    args = parser.parse_args()
+    with profiled("recommend", args.profile):
+        if args.stream or args.ndjson:
+            main_stream(ndjson=args.ndjson)
+        else:
+            main_request()
+
+def main_request():
     # Wrap the entire main process to catch unexpected errors.
     try:
         # Read input from stdin
-        input_data = sys.stdin.read()
+        with stage("read_input") as record:
+            input_data = sys.stdin.read()
+            record["bytes"] = len(input_data)
         if not input_data:
             sys.stderr.write("No input data received.\n")
             print(json.dumps({"error": "No input data received"}))
             sys.stdout.flush()
             sys.exit(1)
-        sys.stderr.write(f"Received input data: {input_data}\n")
     except Exception as e:
         sys.stderr.write(f"Error reading input: {e}\n")
         print(json.dumps({"error": "Error reading input", "details": str(e)}))
@@ -245,38 +925,77 @@ def main():
     
     # Parse JSON input.
     try:
-        data = json.loads(input_data)
+        with stage("parse_json"):
+            data = json.loads(input_data)
     except Exception as e:
         sys.stderr.write(f"Error parsing JSON: {e}\n")
         print(json.dumps({"error": "Error parsing JSON", "details": str(e)}))
         sys.stdout.flush()
         sys.exit(1)
+    sys.stderr.write(f"Received request: {json.dumps(payload_summary(data, len(input_data)))}\n")
     
+    # A request with "users" scores many users against one shared catalog.
+    if "users" in data:
+        main_batch(data)
+        return
+
     # Extract clusters and posts.
     liked_clusters = data.get("likedClusters", [])
     disliked_clusters = data.get("dislikedClusters", [])
     posts = data.get("posts", [])
+    # With a catalog store configured the request may carry only post ids (or just exclusions).
+    store_dir = os.environ.get("CATALOG_STORE_DIR")
     
-    if not liked_clusters or not posts:
+    if not liked_clusters or not (posts or store_dir):
         msg = "Missing required data: likedClusters and posts are required."
         sys.stderr.write(msg + "\n")
         print(json.dumps({"error": msg}))
         sys.stdout.flush()
         sys.exit(1)
+    try:
+        options = request_options(data)
+    except ValueError as e:
+        sys.stderr.write(f"Invalid request parameters: {e}\n")
+        print(json.dumps({"error": "Invalid request parameters", "details": str(e)}))
+        sys.stdout.flush()
+        sys.exit(1)
     
     try:
-        user_liked_centers = np.array(liked_clusters)
-        user_disliked_centers = np.array(disliked_clusters) if disliked_clusters else None
+        user_liked_centers = decode_vectors(liked_clusters)
+        user_disliked_centers = decode_vectors(disliked_clusters) if disliked_clusters else None
     except Exception as e:
         sys.stderr.write(f"Error converting clusters to numpy arrays: {e}\n")
         print(json.dumps({"error": "Error processing clusters", "details": str(e)}))
         sys.stdout.flush()
         sys.exit(1)
+
+    if not posts:
+        try:
+            store = EmbeddingStore(store_dir)
+            with stage("recommend_from_store", rows=len(store)):
+                recommendations_list = recommend_from_store(
+                    store,
+                    user_liked_centers,
+                    user_disliked_centers,
+                    post_ids=data.get("postIds"),
+                    exclude_ids=data.get("excludeIds"),
+                    **options
+                )
+            with stage("serialize", rows=len(recommendations_list)):
+                print(json.dumps(recommendations_list))
+            sys.stdout.flush()
+        except Exception as e:
+            sys.stderr.write(f"Error computing recommendations from catalog store: {e}\n")
+            print(json.dumps({"error": "Error computing recommendations", "details": str(e)}))
+            sys.stdout.flush()
+            sys.exit(1)
+        return
     
     # Initialize the model.
     sys.stderr.write("Initializing SentenceTransformer model...\n")
     try:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        with stage("load_model"):
+            model = load_model()
     except Exception as e:
         sys.stderr.write(f"Error loading model: {e}\n")
         print(json.dumps({"error": "Error loading model", "details": str(e)}))
@@ -284,42 +1003,35 @@ def main():
         sys.exit(1)
     sys.stderr.write("Model loaded successfully.\n")
     
-    # Build the products DataFrame.
+    # Parse the posts into a product batch.
     try:
-        products_df = get_products_dataframe(posts, model)
+        with stage("get_product_batch", rows=len(posts)):
+            products = get_product_batch(posts, model)
     except Exception as e:
-        sys.stderr.write(f"Error building products DataFrame: {e}\n")
-        print(json.dumps({"error": "Error building products DataFrame", "details": str(e)}))
+        sys.stderr.write(f"Error building product batch: {e}\n")
+        print(json.dumps({"error": "Error building product batch", "details": str(e)}))
         sys.stdout.flush()
         sys.exit(1)
     
     # Compute recommendations.
     try:
-        recommendations = recommend_products(
-            user_liked_centers,
-            user_disliked_centers,
-            products_df,
-            top_n=30,
-            dislike_weight=1.0
-        )
+        with stage("recommend_products", rows=len(products)):
+            recommendations_list = recommend_products(
+                user_liked_centers,
+                user_disliked_centers,
+                products,
+                **options
+            )
     except Exception as e:
         sys.stderr.write(f"Error computing recommendations: {e}\n")
         print(json.dumps({"error": "Error computing recommendations", "details": str(e)}))
         sys.stdout.flush()
         sys.exit(1)
     
-    # Prepare output.
-    try:
-        recommendations_list = recommendations[['id', 'description', 'final_score']].to_dict(orient='records')
-    except Exception as e:
-        sys.stderr.write(f"Error preparing output: {e}\n")
-        print(json.dumps({"error": "Error preparing output", "details": str(e)}))
-        sys.stdout.flush()
-        sys.exit(1)
-    
     try:
-        output = json.dumps(recommendations_list)
-        print(output)
+        with stage("serialize", rows=len(recommendations_list)):
+            output = json.dumps(recommendations_list)
+            print(output)
         sys.stdout.flush()
     except Exception as e:
         sys.stderr.write(f"Error converting recommendations to JSON: {e}\n")
@@ -328,5 +1040,7 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
+    # Installed here rather than at import so recommendation_server can import this module.
+    signal.signal(signal.SIGPIPE, handle_sigpipe)
     main()
 
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Long-running HTTP service for recommendation.py and calculatePreferences.py.
+
+The SentenceTransformer model is loaded once at startup and shared by all
+requests, which are served concurrently on a thread per connection. The
+endpoints accept the same JSON as the one-shot CLIs read from stdin:
+
+    POST /recommend              {likedClusters, dislikedClusters, posts, topN?, dislikeWeight?, diversityLambda?}
+                                 -> [{id, description, final_score}, ...]
+    POST /calculate_preferences  {likedDescriptions, dislikedDescriptions, likedWeights?, likedState?, ...}
+                                 -> {likedClusters, dislikedClusters, likedState?, dislikedState?}
+    POST /calculate_preferences_batch  {users: [{userId, likedDescriptions, ...}], wireFormat?}
+                                 -> {results: [{userId, likedClusters, dislikedClusters, ...}, ...]}
+    POST /recommend_batch        {users: [{userId, likedClusters, dislikedClusters, excludeIds}], posts,
+                                  topN?, dislikeWeight?, diversityLambda?}
+                                 -> {results: [{userId, recommendations}, ...]}
+    GET  /health
+    GET  /metrics                per-stage counters in Prometheus text format
+
+With --store (or CATALOG_STORE_DIR) the catalog embeddings are memory-mapped
+from an EmbeddingStore. /recommend may then omit posts and send only
+postIds and/or excludeIds, and new products are added with
+
+    POST /catalog                {posts} -> {added, total}
+
+/recommend also accepts a streamed body with Content-Type application/x-ndjson:
+the first line is the request without posts, then one post per line. Posts
+are scored in chunks as they are read.
+
+With --ann, catalog requests first retrieve candidates from an IVF index
+(ann_index.py) and score only those. With --precision float16|int8 they are
+scored on a compact copy of the catalog (quantization.py), and the best --rerank
+candidates are re-scored on the exact rows. Send "retrieval": "exact" to bypass both.
+Top-N lists are cached per user (result_cache.py): /recommend_batch and
+whole-catalog /recommend requests skip scoring for users whose clusters and
+catalog did not change, filter cached lists for new exclusions and score only
+products added to the store since. Posts requests are cached when they carry a
+"catalogVersion" identifying the posts sent.
+
+With --workers N (or SCORING_WORKERS) each request scores the catalog in N row
+shards in parallel (parallel_scoring.py). With --cluster-mode adaptive (or a
+request's "clusterMode") preferences pick their number of centers per user.
+
+Every request logs one JSON line per stage (parse, scoring, serialization...)
+and a size summary of its payload; see instrumentation.py. --profile (or
+PROFILE) profiles requests with cProfile or tracemalloc.
+
+    python3 recommendation_server.py --port 8000 --store /var/data/catalog
+"""
+import os
+import sys
+import json
+import argparse
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import calculatePreferences
+import recommendation
+from embedding_cache import get_embedding_cache
+from embedding_store import EmbeddingStore
+from result_cache import get_result_cache
+from stream_input import BoundedReader, iter_ndjson_request
+from wire_format import WIRE_FORMATS, decode_vectors
+from instrumentation import PROFILERS, payload_summary, profiled, prometheus_metrics, stage
+import instrumentation
+import parallel_scoring
+import ann_index
+import quantization
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Catalog embedding store, opened in main() when --store is given.
+catalog_store = None
+# IVF index over catalog_store, loaded in main() when --ann is given.
+catalog_index = None
+ann_probe = 8
+# Quantized copy of catalog_store, loaded in main() when --precision is not float32.
+catalog_quantized = None
+rerank_candidates = 100
+# Serializes appends to the quantized copy's files.
+quantize_lock = threading.Lock()
+
+class RequestError(Exception):
+    """
+    An error reported back to the client as {"error": ..., "details": ...}.
+    """
+    def __init__(self, error, details=None, status=400):
+        super().__init__(error)
+        self.error = error
+        self.details = details
+        self.status = status
+
+    def to_dict(self):
+        body = {"error": self.error}
+        if self.details is not None:
+            body["details"] = self.details
+        return body
+
+def request_options(data):
+    try:
+        return recommendation.request_options(data)
+    except ValueError as e:
+        raise RequestError("Invalid request parameters", str(e))
+
+def handle_recommend(data):
+    liked_clusters = data.get("likedClusters", [])
+    disliked_clusters = data.get("dislikedClusters", [])
+    posts = data.get("posts", [])
+    if not liked_clusters or not (posts or catalog_store is not None):
+        raise RequestError("Missing required data: likedClusters and posts are required.")
+    options = request_options(data)
+
+    try:
+        user_liked_centers = decode_vectors(liked_clusters)
+        user_disliked_centers = decode_vectors(disliked_clusters) if disliked_clusters else None
+    except Exception as e:
+        raise RequestError("Error processing clusters", str(e))
+
+    if not posts:
+        options.update({
+            "ann_index": catalog_index if data.get("retrieval") != "exact" else None,
+            "n_probe": ann_probe,
+            "quantized": catalog_quantized if data.get("retrieval") != "exact" else None,
+            "rerank": rerank_candidates,
+        })
+        cache = get_result_cache()
+        try:
+            with stage("recommend_from_store", rows=len(catalog_store)):
+                if data.get("postIds") is None and cache.enabled:
+                    return recommendation.recommend_from_store_cached(
+                        cache,
+                        catalog_store,
+                        user_liked_centers,
+                        user_disliked_centers,
+                        exclude_ids=data.get("excludeIds"),
+                        fingerprint=data.get("clusterFingerprint"),
+                        **options
+                    )
+                return recommendation.recommend_from_store(
+                    catalog_store,
+                    user_liked_centers,
+                    user_disliked_centers,
+                    post_ids=data.get("postIds"),
+                    exclude_ids=data.get("excludeIds"),
+                    **options
+                )
+        except Exception as e:
+            raise RequestError("Error computing recommendations", str(e), status=500)
+
+    model = calculatePreferences.get_model(MODEL_NAME)
+    try:
+        with stage("get_product_batch", rows=len(posts)):
+            products = recommendation.get_product_batch(posts, model)
+    except Exception as e:
+        raise RequestError("Error building product batch", str(e), status=500)
+
+    try:
+        with stage("recommend_products", rows=len(products)):
+            return recommendation.recommend_products(
+                user_liked_centers,
+                user_disliked_centers,
+                products,
+                **options
+            )
+    except Exception as e:
+        raise RequestError("Error computing recommendations", str(e), status=500)
+
+def handle_recommend_batch(data):
+    users = data.get("users")
+    if not isinstance(users, list) or not (data.get("posts") or catalog_store is not None):
+        raise RequestError("Missing required data: users and posts are required.")
+    options = request_options(data)
+    try:
+        model = calculatePreferences.get_model(MODEL_NAME) if data.get("posts") else None
+        rows = len(data["posts"]) if data.get("posts") else len(catalog_store)
+        with stage("recommend_batch", rows=rows, users=len(users)):
+            results = recommendation.recommend_batch_request(
+                data,
+                model=model,
+                store=catalog_store,
+                cache=get_result_cache(),
+                **options
+            )
+    except Exception as e:
+        raise RequestError("Error computing recommendations", str(e), status=500)
+    return {"results": results}
+
+def check_cluster_mode(data):
+    if data.get("clusterMode", calculatePreferences.CLUSTER_MODE) not in calculatePreferences.CLUSTER_MODES:
+        raise RequestError("Invalid clusterMode",
+                           f"expected one of {', '.join(calculatePreferences.CLUSTER_MODES)}")
+
+def handle_calculate_preferences(data):
+    if data.get("wireFormat", "json") not in WIRE_FORMATS:
+        raise RequestError("Invalid wireFormat", f"expected one of {', '.join(WIRE_FORMATS)}")
+    check_cluster_mode(data)
+    rows = len(data.get("likedDescriptions") or []) + len(data.get("dislikedDescriptions") or [])
+    with stage("calculate_preferences", rows=rows):
+        return calculatePreferences.calculate_preferences(data, model_name=MODEL_NAME)
+
+def handle_calculate_preferences_batch(data):
+    if not isinstance(data.get("users"), list):
+        raise RequestError("Missing required data: users are required.")
+    if data.get("wireFormat", "json") not in WIRE_FORMATS:
+        raise RequestError("Invalid wireFormat", f"expected one of {', '.join(WIRE_FORMATS)}")
+    check_cluster_mode(data)
+    try:
+        with stage("calculate_preferences_batch", users=len(data["users"])):
+            results = calculatePreferences.calculate_preferences_batch(data, model_name=MODEL_NAME)
+    except Exception as e:
+        raise RequestError("Error computing preferences", str(e), status=500)
+    return {"results": results}
+
+def handle_catalog(data):
+    global catalog_quantized
+    if catalog_store is None:
+        raise RequestError("No catalog store configured", status=404)
+    posts = data.get("posts", [])
+    try:
+        with stage("add_posts", rows=len(posts)):
+            added = catalog_store.add_posts(posts, calculatePreferences.get_model(MODEL_NAME))
+    except Exception as e:
+        raise RequestError("Error adding posts to catalog store", str(e), status=500)
+    if catalog_quantized is not None and added:
+        with quantize_lock, stage("quantize", rows=added):
+            catalog_quantized = quantization.load_or_build(catalog_store, catalog_quantized.precision)
+    return {"added": added, "total": len(catalog_store)}
+
+ROUTES = {
+    "/recommend": handle_recommend,
+    "/recommend_batch": handle_recommend_batch,
+    "/calculate_preferences": handle_calculate_preferences,
+    "/calculate_preferences_batch": handle_calculate_preferences_batch,
+    "/catalog": handle_catalog,
+}
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        with stage("serialize", rows=len(body) if isinstance(body, list) else None):
+            payload = json.dumps(body).encode("utf-8")
+        self.send_bytes(status, payload, "application/json")
+
+    def send_bytes(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path in ("/", "/health"):
+            self.send_json(200, {
+                "status": "ok",
+                "model": MODEL_NAME,
+                "embeddingCache": get_embedding_cache(MODEL_NAME).stats(),
+                "resultCache": get_result_cache().stats(),
+            })
+        elif self.path == "/metrics":
+            self.send_bytes(200, prometheus_metrics().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def recommend_ndjson(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        events = iter_ndjson_request(BoundedReader(self.rfile, length))
+        try:
+            with profiled(self.path), stage("recommend_stream", bytes=length):
+                result = recommendation.recommend_stream(events, calculatePreferences.get_model(MODEL_NAME))
+        except Exception as e:
+            # The rest of the body may be unread; do not reuse the connection.
+            self.close_connection = True
+            sys.stderr.write(f"{self.path}: Error computing streamed recommendations {e}\n")
+            self.send_json(400 if isinstance(e, ValueError) else 500,
+                           {"error": "Error computing recommendations", "details": str(e)})
+            return
+        self.send_json(200, result)
+
+    def do_POST(self):
+        handler = ROUTES.get(self.path)
+        if handler is None:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        if self.path == "/recommend" and self.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+            self.recommend_ndjson()
+            return
+        with profiled(self.path):
+            self.handle_json(handler)
+
+    def handle_json(self, handler):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            with stage("parse_json", bytes=length):
+                data = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(data, dict):
+                raise ValueError("request body must be a JSON object")
+        except Exception as e:
+            self.send_json(400, {"error": "Error parsing JSON", "details": str(e)})
+            return
+        sys.stderr.write(f"{self.path}: {json.dumps(payload_summary(data, length))}\n")
+        try:
+            self.send_json(200, handler(data))
+        except RequestError as e:
+            sys.stderr.write(f"{self.path}: {e.error} {e.details or ''}\n")
+            self.send_json(e.status, e.to_dict())
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": "Internal server error", "details": str(e)})
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+def main():
+    global catalog_store, catalog_index, ann_probe, catalog_quantized, rerank_candidates
+    parser = argparse.ArgumentParser(description="Recommendation HTTP service")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--store", default=os.environ.get("CATALOG_STORE_DIR"),
+                        help="directory of the catalog embedding store")
+    parser.add_argument("--ann", action="store_true",
+                        help="retrieve candidates from an IVF index over the store before exact scoring")
+    parser.add_argument("--ann-probe", type=int, default=ann_probe,
+                        help="IVF cells visited per liked center")
+    parser.add_argument("--precision", choices=quantization.PRECISIONS, default="float32",
+                        help="score catalog requests on a float16 or int8 copy of the store")
+    parser.add_argument("--rerank", type=int, default=rerank_candidates,
+                        help="with --precision, re-score this many best candidates on the exact rows (0 disables)")
+    parser.add_argument("--workers", type=int, default=parallel_scoring.WORKERS,
+                        help="threads scoring catalog shards per request; 0 for one per CPU "
+                             "(default: SCORING_WORKERS env var, else 1)")
+    parser.add_argument("--cluster-workers", type=int, default=calculatePreferences.CLUSTER_WORKERS,
+                        help="threads fitting users' clusters in /calculate_preferences_batch; 0 for one per CPU "
+                             "(default: CLUSTER_WORKERS env var, else 1)")
+    parser.add_argument("--cluster-mode", choices=calculatePreferences.CLUSTER_MODES,
+                        default=calculatePreferences.CLUSTER_MODE,
+                        help="fixed: DEFAULT_NUM_CLUSTERS centers per side; adaptive: choose per user "
+                             "(default: CLUSTER_MODE env var, else fixed)")
+    parser.add_argument("--profile", choices=PROFILERS, default=instrumentation.PROFILE,
+                        help="profile each request with cProfile or tracemalloc (default: PROFILE env var)")
+    args = parser.parse_args()
+    instrumentation.PROFILE = args.profile
+    parallel_scoring.WORKERS = args.workers
+    calculatePreferences.CLUSTER_WORKERS = args.cluster_workers
+    calculatePreferences.CLUSTER_MODE = args.cluster_mode
+
+    if args.store:
+        catalog_store = EmbeddingStore(args.store)
+        sys.stderr.write(f"Catalog store {args.store}: {len(catalog_store)} products\n")
+        if args.ann and len(catalog_store):
+            catalog_index = ann_index.load_or_build(catalog_store)
+            ann_probe = args.ann_probe
+            sys.stderr.write(f"ANN index: {catalog_index.n_lists} lists over {catalog_index.size} rows\n")
+        if args.precision != "float32":
+            catalog_quantized = quantization.load_or_build(catalog_store, args.precision)
+            rerank_candidates = args.rerank
+            sys.stderr.write(f"Quantized catalog: {args.precision}, {catalog_quantized.nbytes} bytes\n")
+
+    # Load the model before accepting connections so no request pays for it.
+    calculatePreferences.get_model(MODEL_NAME)
+
+    server = ThreadingHTTPServer((args.host, args.port), RecommendationHandler)
+    server.daemon_threads = True
+    sys.stderr.write(f"Recommendation service listening on {args.host}:{args.port}\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Cache of users' top-N recommendation lists.
+
+An entry is keyed by a fingerprint of the user's cluster centers, the catalog
+and the scoring options. It holds the best top_n + overfetch results for the
+exclusions in effect when it was computed, and the catalog version they were
+computed against. A later request with the same key is answered
+
+    from the entry as is      when nothing changed
+    by filtering the entry    when it only excludes more ids (e.g. newly liked
+                              posts), as long as top_n results survive
+    by scoring only new rows  when the catalog is append-only (an EmbeddingStore,
+                              whose version is its row count) and has grown
+
+and recomputed otherwise. Configure the shared cache with:
+
+    RESULT_CACHE_SIZE       max cached lists (default 10000, 0 disables)
+    RESULT_CACHE_OVERFETCH  results kept beyond top_n for later exclusions (default 50)
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def cluster_fingerprint(liked, disliked=None):
+    """
+    Hash of a user's centers as recommendation.as_centers returns them.
+    """
+    digest = hashlib.sha256()
+    for centers in (liked, disliked):
+        if centers is None:
+            digest.update(b"none")
+        else:
+            centers = np.ascontiguousarray(centers, dtype=np.float32)
+            digest.update(repr(centers.shape).encode("ascii"))
+            digest.update(centers.tobytes())
+    return digest.hexdigest()
+
+class CachedResults:
+    """
+    One user's results (best first, [{id, description, final_score}]) for the
+    catalog at version, with the ids in excluded left out.
+    """
+
+    def __init__(self, version, excluded, results, count):
+        self.version = version
+        self.excluded = excluded
+        self.results = results
+        self.count = count
+        # Fewer results than asked for: every scoreable product is in the list.
+        self.exhausted = len(results) < count
+
+    def answer(self, excluded, top_n):
+        """
+        The top_n results with excluded (a frozenset of ids) left out, or None when
+        they cannot be derived from this entry.
+        """
+        if not excluded >= self.excluded:
+            return None
+        results = self.results
+        if excluded != self.excluded:
+            results = [result for result in results if str(result["id"]) not in excluded]
+        if len(results) < top_n and not self.exhausted:
+            return None
+        return results[:top_n]
+
+    def extended(self, version, new_results):
+        """
+        This entry merged with the results for the rows added since its version
+        (computed with the same exclusions).
+        """
+        # A product added while the entry was computed may already be in it.
+        known = {result["id"] for result in self.results}
+        new_results = [result for result in new_results if result["id"] not in known]
+        # Stable: on equal scores older products stay ahead, as in a full scan.
+        merged = sorted(self.results + new_results, key=lambda result: -result["final_score"])
+        return CachedResults(version, self.excluded, merged[:self.count], self.count)
+
+class ResultCache:
+    """
+    Bounded LRU of CachedResults, safe to share between request threads.
+    """
+
+    def __init__(self, max_entries=10000, overfetch=50):
+        self.max_entries = max_entries
+        self.overfetch = overfetch
+        self.hits = 0
+        self.filtered = 0
+        self.incremental = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "filtered": self.filtered,
+            "incremental": self.incremental,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+    def get(self, key, version, append_only=False):
+        """
+        The entry for key if it is for this catalog version, or (for an append-only
+        catalog) an earlier one that only needs the new rows scored; else None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.version == version or (append_only and entry.version < version):
+                self._entries.move_to_end(key)
+                return entry
+            return None
+
+    def put(self, key, entry):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """
+    Process-wide result cache, configured from the environment.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(
+                max_entries=int(os.environ.get("RESULT_CACHE_SIZE", 10000)),
+                overfetch=int(os.environ.get("RESULT_CACHE_OVERFETCH", 50)),
+            )
+        return _cache
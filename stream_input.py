@@ -0,0 +1,97 @@
+"""
+Incremental readers for /recommend payloads too large to load at once.
+
+Both readers yield ("field", key, value) for top-level request fields and
+("post", post) for each entry of "posts", one at a time, so the caller never
+holds the whole catalog in memory.
+
+    iter_json_request   a regular JSON request body, parsed with ijson
+                        (optional dependency; send likedClusters before posts)
+    iter_ndjson_request NDJSON: the first line is the request without posts,
+                        every following line is one post
+"""
+import json
+
+class BoundedReader:
+    """
+    File-like view of the first `length` bytes of a stream (e.g. an HTTP request body).
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.stream.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+def iter_ndjson_request(stream):
+    header = None
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if header is None:
+            header = json.loads(line)
+            if not isinstance(header, dict):
+                raise ValueError("the first NDJSON line must be a JSON object")
+            for key, value in header.items():
+                if key != "posts":
+                    yield ("field", key, value)
+            for post in header.get("posts") or []:
+                yield ("post", post)
+            continue
+        yield ("post", json.loads(line))
+
+def iter_json_request(stream):
+    try:
+        import ijson
+        from ijson.common import ObjectBuilder
+    except ImportError:
+        raise RuntimeError("streaming JSON input needs the ijson package (pip install ijson)")
+
+    key = None
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix == "":
+            if event == "map_key":
+                key = value
+            continue
+        if key == "posts" and prefix == "posts" and event in ("start_array", "end_array"):
+            continue
+        if builder is None:
+            builder = ObjectBuilder()
+            depth = 0
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            if key == "posts":
+                yield ("post", builder.value)
+            else:
+                yield ("field", key, builder.value)
+            builder = None